@@ -1,203 +1,568 @@
+import argparse
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import geopandas as gpd
-import rasterio
 from rasterio.features import rasterize
 from rasterio.transform import from_origin
 import os
 import numpy as np
-import xarray as xr
 import pandas as pd
 from netCDF4 import Dataset
-import rioxarray
+from scipy.ndimage import distance_transform_edt
+from shapely import STRtree, box
+from city_analysis import earth_radius_km
+from point_grid import point_counts
+
+# Constraint Rasterization
+# The constraint shapefiles of constraint_layers are rasterized tile by tile onto the target grid,
+# burning only the geometries that intersect each tile, and every tile is streamed to a chunked,
+# compressed NetCDF as it finishes. Memory is bounded by the tile size even on fine grids (e.g.
+# --resolution 0.001 for about 100 m), and --workers rasterizes the tiles in a process pool. With
+# --coverage each cell stores the fraction covered by each layer instead, for
+# final.py --protected-area-coverage.
+#
+# The features of distance_layers become distance-to-feature rasters in km on the model grid, so a
+# buffer of any size is buffer_mask(distance, km) without rasterizing buffered geometries.
 
 # Directory Setup
 base_directory = '/Users/jamesquessy/Developer/Projects/Masters/Data/Raster_Data'
 shape_file_directory = os.path.join(base_directory, 'Raw_Data')
 airport_file_directory = os.path.join(base_directory, 'Raw_Data')
-
-# Check necessary directories exist
-os.makedirs(shape_file_directory, exist_ok=True)
-os.makedirs(airport_file_directory, exist_ok=True)
-
-# NSA Mask Creation
-
-# Rasterising the NSA Shapefile
-nsa_shapefile_path = os.path.join(shape_file_directory, 'National_Scenic_Areas_-_Scotland.shp')
-shapes = gpd.read_file(nsa_shapefile_path)
-resolution = 0.1 
-left, bottom, right, top = (-44.5, 22.05, 64.9, 72.55) 
-rows = int((top - bottom) / resolution) 
-cols = int((right - left) / resolution) 
-transform = from_origin(left, top, resolution, resolution) 
-nsa_raster_output_path = os.path.join(shape_file_directory, 'nsa_raster.tif') 
-out_shape = (rows, cols) 
-
-# Define metadata for the output raster file.
-out_meta = {
-    "driver": "GTiff",
-    "height": out_shape[0],
-    "width": out_shape[1],
-    "transform": transform,
-    "crs": 'EPSG:4326',
-    "dtype": 'uint8',
-    "nodata": 0,
-    "count": 1
-}
-
-# Rasterising the shapefile
-with rasterio.open(nsa_raster_output_path, 'w', **out_meta) as out_raster:
-    out_raster.write_band(1, rasterize(
-        [(geometry, 1) for geometry in shapes.geometry],
+constraint_mask_file_path = os.path.join(shape_file_directory, 'constraint_masks.nc')
+distance_file_path = os.path.join(shape_file_directory, 'distance_layers.nc')
+
+# Target grid: the cell centres of the model grid
+resolution = 0.1
+left, bottom, right, top = (-44.5, 22.05, 64.9, 72.55)
+tile_size = 1024  # Rows and columns of the grid rasterized at once, and the chunk size of the output.
+workers = 1  # Number of worker processes rasterizing tiles (1 runs them in this process).
+complevel = 4  # zlib compression level of the output.
+coverage_supersample = 10  # Sub-cells per grid cell side sampled for the coverage fraction masks.
+
+# Constraint layers as (shapefile, output variable, burn value). Layers sharing an output
+# variable are burned in order, so later layers overwrite earlier ones where they overlap.
+constraint_layers = [
+    (os.path.join(shape_file_directory, 'National_Scenic_Areas_-_Scotland.shp'), 'nsa', 1),
+    (os.path.join(shape_file_directory, 'Special_Protection_Areas.shp'), 'spa', 1)
+]
+
+# Distance layers as (features file, output variable): shapefiles of points, lines or polygons,
+# or CSV files of points with the point_columns.
+distance_layers = [
+    (os.path.join(airport_file_directory, 'scotland_airports.csv'), 'airport_distance')
+]
+point_columns = ('latitude_deg', 'longitude_deg')  # Latitude and longitude columns of point CSV files.
+max_distance = 100  # Distance in km up to which distance layers are computed; farther cells are stored as inf.
+write_distances = False  # Also write the distance layers, on the model grid at the default resolution.
+distance_band_rows = 4  # Minimum rows of the grid per distance transform band; bands are at least max_distance tall.
+
+def target_grid(left=left, bottom=bottom, right=right, top=top, resolution=resolution):
+    """
+    Build the cell centres of a regular latitude/longitude grid.
+
+    Parameters:
+    - left, bottom, right, top: Centres of the outermost grid cells in degrees.
+    - resolution: Grid step in degrees.
+
+    Returns:
+    - Tuple of (ascending latitudes, ascending longitudes).
+    """
+    lat = bottom + np.arange(int(round((top - bottom) / resolution)) + 1) * resolution
+    lon = left + np.arange(int(round((right - left) / resolution)) + 1) * resolution
+    return lat, lon
+
+def grid_tiles(shape, tile_size=tile_size):
+    """
+    Split a grid into tiles.
+
+    Parameters:
+    - shape: (rows, columns) of the grid.
+    - tile_size: Rows and columns per tile.
+
+    Returns:
+    - List of (row slice, column slice) tuples covering the grid.
+    """
+    return [(slice(row, min(row + tile_size, shape[0])), slice(col, min(col + tile_size, shape[1])))
+            for row in range(0, shape[0], tile_size) for col in range(0, shape[1], tile_size)]
+
+def load_layer_shapes(specs):
+    """
+    Read the shapefiles of the constraint layers in longitude/latitude (EPSG:4326).
+
+    Parameters:
+    - specs: List of (shapefile, output variable, burn value) tuples.
+
+    Returns:
+    - Dictionary of output variable -> (array of geometries, array of burn values), in spec order.
+    """
+    layers = {}
+    for shapefile_path, variable, burn_value in specs:
+        shapes = gpd.read_file(shapefile_path)
+        if shapes.crs is not None and shapes.crs.to_epsg() != 4326:
+            shapes = shapes.to_crs(epsg=4326)
+        geometries = shapes.geometry[shapes.geometry.notna() & ~shapes.geometry.is_empty].to_numpy()
+        layer_geometries, layer_values = layers.setdefault(variable, ([], []))
+        layer_geometries.extend(geometries)
+        layer_values.extend([burn_value] * len(geometries))
+    return {variable: (np.array(geometries, dtype=object), np.array(values))
+            for variable, (geometries, values) in layers.items()}
+
+def tile_bounds(lat, lon, rows, cols):
+    """
+    Return the edges of one tile of the grid.
+
+    Parameters:
+    - lat: Ascending latitudes of the grid cell centres.
+    - lon: Ascending longitudes of the grid cell centres.
+    - rows: Slice of the tile rows, in ascending latitude order.
+    - cols: Slice of the tile columns.
+
+    Returns:
+    - Tuple of (west, south, east, north) edges in degrees.
+    """
+    step_lat, step_lon = lat[1] - lat[0], lon[1] - lon[0]
+    return (lon[cols.start] - step_lon / 2, lat[rows.start] - step_lat / 2,
+            lon[cols.stop - 1] + step_lon / 2, lat[rows.stop - 1] + step_lat / 2)
+
+def rasterize_tile(geometries, burn_values, tree, lat, lon, rows, cols, dtype, all_touched=True):
+    """
+    Burn the geometries intersecting one tile of the grid.
+
+    Parameters:
+    - geometries: Array of geometries of the layer.
+    - burn_values: Burn value of each geometry.
+    - tree: STRtree of the geometries.
+    - lat: Ascending latitudes of the grid cell centres.
+    - lon: Ascending longitudes of the grid cell centres.
+    - rows: Slice of the tile rows, in ascending latitude order.
+    - cols: Slice of the tile columns.
+    - dtype: Data type of the raster.
+    - all_touched: Burn every cell touched by a geometry, not only those whose centre is inside.
+
+    Returns:
+    - Array of shape (rows, columns) in ascending latitude order.
+    """
+    step_lat, step_lon = lat[1] - lat[0], lon[1] - lon[0]
+    west, south, east, north = tile_bounds(lat, lon, rows, cols)
+    out_shape = (rows.stop - rows.start, cols.stop - cols.start)
+
+    # Only the geometries whose bounding box intersects the tile are burned, in their original order
+    hits = np.sort(tree.query(box(west, south, east, north)))
+    if hits.size == 0:
+        return np.zeros(out_shape, dtype=dtype)
+    tile = rasterize(
+        zip(geometries[hits], burn_values[hits]),
         out_shape=out_shape,
-        transform=transform,
+        transform=from_origin(west, north, step_lon, step_lat),
         fill=0,
-        all_touched=True
-    ))
-
-# Converting Raster to NetCDF
-with rasterio.open(nsa_raster_output_path) as src:
-    raster_data = src.read(1)
-    transform = src.transform
-    crs = src.crs
-
-    lon = np.arange(transform[2], transform[2] + transform[0] * raster_data.shape[1], transform[0])
-    lat = np.arange(transform[5], transform[5] + transform[4] * raster_data.shape[0], transform[4])
-    if lat[0] > lat[-1]:
-        lat = lat[::-1]
-        raster_data = raster_data[::-1, :]
-
-    nsa_raster_da = xr.DataArray(
-        data=raster_data,
-        dims=('lat', 'lon'),
-        coords={'lon': lon, 'lat': lat},
-        name='mask'
+        all_touched=all_touched,
+        dtype=dtype
     )
-
-    nsa_raster_ds = xr.Dataset({'mask': nsa_raster_da})
-    nsa_raster_ds.rio.write_crs(crs.to_string(), inplace=True)
-
-    nsa_netcdf_output_path = os.path.join(shape_file_directory, 'nsa_raster_NetCDF.nc')
-    nsa_raster_ds.to_netcdf(nsa_netcdf_output_path)
-    print(f'NSA raster data has been saved to NetCDF file at: {nsa_netcdf_output_path}')
-
-# Speical Protetion Area Mask Creation
-
-# Rasterising the NSA Shapefile
-spa_shapefile_path = os.path.join(shape_file_directory, 'Special_Protection_Areas.shp')
-shapes = gpd.read_file(spa_shapefile_path)
-resolution = 0.1  
-left, bottom, right, top = (-44.5, 22.05, 64.9, 72.55)  
-rows = int((top - bottom) / resolution) 
-cols = int((right - left) / resolution)  
-transform = from_origin(left, top, resolution, resolution) 
-spa_raster_output_path = os.path.join(shape_file_directory, 'spa_raster.tif')  
-out_shape = (rows, cols) 
-
-# Define metadata for the output raster file.
-out_meta = {
-    "driver": "GTiff",
-    "height": out_shape[0],
-    "width": out_shape[1],
-    "transform": transform,
-    "crs": 'EPSG:4326',
-    "dtype": 'uint8',
-    "nodata": 0,
-    "count": 1
-}
-
-# Rasterising the shapefile
-with rasterio.open(nsa_raster_output_path, 'w', **out_meta) as out_raster:
-    out_raster.write_band(1, rasterize(
-        [(geometry, 1) for geometry in shapes.geometry],
-        out_shape=out_shape,
-        transform=transform,
-        fill=0,
-        all_touched=True
-    ))
-
-# Converting Raster to NetCDF for NSA
-with rasterio.open(nsa_raster_output_path) as src:
-    raster_data = src.read(1)
-    transform = src.transform
-    crs = src.crs
-
-    lon = np.arange(transform[2], transform[2] + transform[0] * raster_data.shape[1], transform[0])
-    lat = np.arange(transform[5], transform[5] + transform[4] * raster_data.shape[0], transform[4])
-    if lat[0] > lat[-1]:
-        lat = lat[::-1]
-        raster_data = raster_data[::-1, :]
-
-    spa_raster_da = xr.DataArray(
-        data=raster_data,
-        dims=('lat', 'lon'),
-        coords={'lon': lon, 'lat': lat},
-        name='mask'
-    )
-
-    spa_raster_ds = xr.Dataset({'mask': spa_raster_da})
-    spa_raster_ds.rio.write_crs(crs.to_string(), inplace=True)
-
-    spa_netcdf_output_path = os.path.join(shape_file_directory, 'spa_raster_NetCDF.nc')
-    spa_raster_ds.to_netcdf(spa_netcdf_output_path)
-    print(f'SPA raster data has been saved to NetCDF file at: {nsa_netcdf_output_path}')
+    return tile[::-1]
+
+def coverage_tile(geometries, tree, lat, lon, rows, cols, supersample=coverage_supersample):
+    """
+    Compute the fraction of each grid cell of one tile covered by the geometries.
+
+    Every cell is split into supersample x supersample sub-cells, the sub-cells whose centre is
+    inside a geometry are burned, and the fraction is their share per cell. The sub-cells are
+    rasterized in strips of about a tile of sub-cells, so memory does not grow with supersample.
+
+    Parameters:
+    - geometries: Array of geometries of the layer.
+    - tree: STRtree of the geometries.
+    - lat: Ascending latitudes of the grid cell centres.
+    - lon: Ascending longitudes of the grid cell centres.
+    - rows: Slice of the tile rows, in ascending latitude order.
+    - cols: Slice of the tile columns.
+    - supersample: Sub-cells per grid cell side.
+
+    Returns:
+    - float32 array of shape (rows, columns) in ascending latitude order, between 0 and 1.
+    """
+    step_lat, step_lon = lat[1] - lat[0], lon[1] - lon[0]
+    west, south, east, north = tile_bounds(lat, lon, rows, cols)
+    n_rows, n_cols = rows.stop - rows.start, cols.stop - cols.start
+    fraction = np.zeros((n_rows, n_cols), dtype=np.float32)
+
+    hits = tree.query(box(west, south, east, north))
+    if hits.size == 0:
+        return fraction
+    shapes = geometries[np.sort(hits)]
+    strip_rows = max(1, n_rows // supersample)
+    for strip_start in range(0, n_rows, strip_rows):
+        strip = slice(strip_start, min(strip_start + strip_rows, n_rows))
+        # Strips run from the north edge down, as the rasterized rows do
+        strip_north = north - strip.start * step_lat
+        sub_cells = rasterize(
+            ((geometry, 1) for geometry in shapes),
+            out_shape=((strip.stop - strip.start) * supersample, n_cols * supersample),
+            transform=from_origin(west, strip_north, step_lon / supersample, step_lat / supersample),
+            fill=0,
+            all_touched=False,
+            dtype=np.uint8
+        )
+        fraction[strip] = sub_cells.reshape(strip.stop - strip.start, supersample, n_cols, supersample).mean(axis=(1, 3), dtype=np.float32)
+    return fraction[::-1]
+
+def layer_dtype(burn_values):
+    """
+    Return the smallest unsigned integer type holding the burn values of a layer, at least uint8.
+
+    Parameters:
+    - burn_values: Burn values of the layer.
+    """
+    return np.result_type(np.min_scalar_type(burn_values.max()), np.uint8) if burn_values.size else np.dtype(np.uint8)
+
+def rasterize_tile_layers(layers, trees, lat, lon, rows, cols, all_touched=True, coverage=None):
+    """
+    Rasterize every constraint layer over one tile of the grid.
+
+    Parameters:
+    - layers: Layers from `load_layer_shapes`.
+    - trees: Dictionary of output variable -> STRtree of its geometries.
+    - lat: Ascending latitudes of the grid cell centres.
+    - lon: Ascending longitudes of the grid cell centres.
+    - rows: Slice of the tile rows, in ascending latitude order.
+    - cols: Slice of the tile columns.
+    - all_touched: Burn every cell touched by a geometry, not only those whose centre is inside.
+    - coverage: Sub-cells per cell side for coverage fraction masks (see `coverage_tile`); None burns the burn values.
+
+    Returns:
+    - Dictionary of output variable -> tile array, without the layers that burn nothing in the tile.
+    """
+    tiles = {}
+    for variable, (geometries, burn_values) in layers.items():
+        if coverage:
+            tile = coverage_tile(geometries, trees[variable], lat, lon, rows, cols, coverage)
+        else:
+            tile = rasterize_tile(geometries, burn_values, trees[variable], lat, lon, rows, cols, layer_dtype(burn_values), all_touched)
+        if tile.any():
+            tiles[variable] = tile
+    return tiles
+
+def layer_attrs(variable, coverage=None):
+    """
+    Return the attributes of the raster of a constraint layer.
+
+    Parameters:
+    - variable: Output variable of the layer.
+    - coverage: Sub-cells per cell side of coverage fraction masks; None for burned masks.
+    """
+    if coverage:
+        return {'long_name': f"{variable.upper()} coverage fraction", 'units': '1', 'supersample': coverage}
+    return {'long_name': f"{variable.upper()} constraint mask"}
+
+def create_grid(output, lat, lon):
+    """
+    Create the latitude/longitude dimensions and coordinates of a NetCDF file.
+
+    Parameters:
+    - output: Open netCDF4 Dataset.
+    - lat: Ascending latitudes of the grid cell centres.
+    - lon: Ascending longitudes of the grid cell centres.
+    """
+    output.createDimension('lat', len(lat))
+    output.createDimension('lon', len(lon))
+    output.createVariable('lat', np.float64, ('lat',))[:] = lat
+    output.createVariable('lon', np.float64, ('lon',))[:] = lon
+    output['lat'].setncatts({'units': 'degrees_north', 'standard_name': 'latitude'})
+    output['lon'].setncatts({'units': 'degrees_east', 'standard_name': 'longitude'})
+    output.crs = 'EPSG:4326'
+
+_worker_layers = None
+
+def _init_worker(layers, lat, lon, all_touched, coverage):
+    global _worker_layers
+    # Every worker builds its own spatial indices once
+    trees = {variable: STRtree(geometries) for variable, (geometries, _) in layers.items()}
+    _worker_layers = (layers, trees, lat, lon, all_touched, coverage)
+
+def _rasterize_tile_job(rows, cols):
+    layers, trees, lat, lon, all_touched, coverage = _worker_layers
+    return rows, cols, rasterize_tile_layers(layers, trees, lat, lon, rows, cols, all_touched, coverage)
+
+def write_layers(specs, output_path, lat, lon, tile_size=tile_size, workers=workers, all_touched=True, complevel=complevel,
+                 coverage=None):
+    """
+    Rasterize several constraint layers tile by tile and stream them to a chunked, compressed NetCDF file.
+
+    Every tile is one chunk of the output and is written as soon as it is rasterized, so memory is
+    bounded by a few tiles whatever the grid size. With several workers the tiles are rasterized in
+    a process pool.
+
+    Parameters:
+    - specs: List of (shapefile, output variable, burn value) tuples.
+    - output_path: Output NetCDF file.
+    - lat: Ascending latitudes of the grid cell centres.
+    - lon: Ascending longitudes of the grid cell centres.
+    - tile_size: Rows and columns rasterized at once, and the chunk size of the output.
+    - workers: Number of worker processes; 1 rasterizes every tile in this process.
+    - all_touched: Burn every cell touched by a geometry, not only those whose centre is inside.
+    - complevel: zlib compression level.
+    - coverage: Sub-cells per cell side for float coverage fraction masks instead of burned masks.
+
+    Returns:
+    - Number of tiles in which at least one layer burned something.
+    """
+    layers = load_layer_shapes(specs)
+    tiles = grid_tiles((len(lat), len(lon)), tile_size)
+    chunk_sizes = (min(tile_size, len(lat)), min(tile_size, len(lon)))
+
+    with Dataset(output_path, 'w') as output:
+        create_grid(output, lat, lon)
+        dtypes = {variable: np.dtype(np.float32) if coverage else layer_dtype(burn_values)
+                  for variable, (_, burn_values) in layers.items()}
+        for variable, dtype in dtypes.items():
+            nc_variable = output.createVariable(variable, dtype, ('lat', 'lon'), zlib=True, complevel=complevel,
+                                                chunksizes=chunk_sizes)
+            nc_variable.setncatts(layer_attrs(variable, coverage))
+
+        def write(rows, cols, tile_layers):
+            # Layers burning nothing in the tile are written as zeros, which compress to almost nothing
+            for variable, dtype in dtypes.items():
+                output[variable][rows, cols] = tile_layers.get(variable, np.zeros((rows.stop - rows.start, cols.stop - cols.start),
+                                                                                  dtype=dtype))
+            return bool(tile_layers)
+
+        burned = 0
+        if workers <= 1:
+            _init_worker(layers, lat, lon, all_touched, coverage)
+            for rows, cols in tiles:
+                burned += write(*_rasterize_tile_job(rows, cols))
+        else:
+            # Spawn rather than fork so workers do not inherit the open NetCDF file
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                     initargs=(layers, lat, lon, all_touched, coverage)) as executor:
+                # Keep only a few tiles in flight so finished tiles do not pile up in memory
+                pending = set()
+                for rows, cols in tiles:
+                    pending.add(executor.submit(_rasterize_tile_job, rows, cols))
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        burned += sum(write(*future.result()) for future in done)
+                burned += sum(write(*future.result()) for future in pending)
+    return burned
+
+def load_features(source, point_columns=point_columns):
+    """
+    Read the features of a distance layer in longitude/latitude (EPSG:4326).
+
+    Parameters:
+    - source: Shapefile, or CSV file of points.
+    - point_columns: (latitude, longitude) columns of CSV files, in degrees.
+
+    Returns:
+    - Array of geometries.
+    """
+    if source.lower().endswith('.csv'):
+        points = pd.read_csv(source)
+        lat_column, lon_column = point_columns
+        shapes = gpd.GeoSeries(gpd.points_from_xy(points[lon_column], points[lat_column]), crs='EPSG:4326')
+    else:
+        shapes = gpd.read_file(source).geometry
+        if shapes.crs is not None and shapes.crs.to_epsg() != 4326:
+            shapes = shapes.to_crs(epsg=4326)
+    return shapes[shapes.notna() & ~shapes.is_empty].to_numpy()
+
+def feature_cells(geometries, lat, lon, tile_size=tile_size):
+    """
+    Mark the grid cells touched by any feature.
+
+    Parameters:
+    - geometries: Array of point, line or polygon geometries.
+    - lat: Ascending latitudes of the grid cell centres.
+    - lon: Ascending longitudes of the grid cell centres.
+    - tile_size: Rows and columns rasterized at once.
+
+    Returns:
+    - Boolean array of shape (lat, lon).
+    """
+    tree = STRtree(geometries)
+    burn_values = np.ones(len(geometries), dtype=np.uint8)
+    cells = np.zeros((len(lat), len(lon)), dtype=bool)
+    for rows, cols in grid_tiles((len(lat), len(lon)), tile_size):
+        cells[rows, cols] = rasterize_tile(geometries, burn_values, tree, lat, lon, rows, cols, np.uint8) != 0
+    return cells
+
+def distance_to_features(cells, lat, lon, output, max_distance=max_distance, band_rows=distance_band_rows):
+    """
+    Compute the great circle distance from every grid cell to the nearest feature cell, band by band.
+
+    The grid is processed in bands of rows at least max_distance tall. In each band a Euclidean
+    distance transform picks the nearest feature cell, with cells scaled to their width in km at
+    the latitude of the band, and the distance to that cell is then the great circle distance
+    from each cell centre. The transform of a band only sees the band and the rows within
+    max_distance of it, at most three bands, so the whole grid costs at most three transforms of
+    the grid, and each band is written to the output as soon as it is done.
+    Without max_distance the whole grid is one band, scaled to the width at its mean latitude.
+
+    Parameters:
+    - cells: Boolean array of shape (lat, lon) marking the feature cells, see `feature_cells`.
+    - lat: Ascending latitudes of the grid cell centres.
+    - lon: Ascending longitudes of the grid cell centres.
+    - output: Array or NetCDF variable of shape (lat, lon) receiving the float32 distances in km
+      between cell centres, 0 on feature cells and inf beyond max_distance.
+    - max_distance: Distance in km beyond which cells are set to inf; None computes every distance.
+    - band_rows: Minimum rows per band.
+
+    Returns:
+    - Number of bands with a feature within max_distance.
+    """
+    n_rows = len(lat)
+    row_km = np.radians(lat[1] - lat[0]) * earth_radius_km
+    col_km = np.radians(lon[1] - lon[0]) * earth_radius_km
+    margin = n_rows if max_distance is None else int(np.ceil(max_distance / row_km)) + 1
+    # Bands as tall as the margin keep the rows transformed per band within three bands
+    band_rows = max(band_rows, min(margin, n_rows))
+    lat_radians, lon_radians = np.radians(lat), np.radians(lon)
+
+    near = 0
+    for start in range(0, n_rows, band_rows):
+        rows = slice(start, min(start + band_rows, n_rows))
+        window = slice(max(0, rows.start - margin), min(n_rows, rows.stop + margin))
+        if not cells[window].any():
+            output[rows] = np.full((rows.stop - rows.start, len(lon)), np.inf, dtype=np.float32)
+            continue
+        # Feature cells are the zeros of the transform input
+        sampling = (row_km, col_km * np.cos(lat_radians[rows].mean()))
+        nearest_rows, nearest_cols = distance_transform_edt(~cells[window], sampling=sampling, return_distances=False,
+                                                           return_indices=True)
+        band = slice(rows.start - window.start, rows.stop - window.start)
+        nearest_lat = lat_radians[nearest_rows[band] + window.start]
+        nearest_lon = lon_radians[nearest_cols[band]]
+        del nearest_rows, nearest_cols
+
+        # Haversine distance from each cell centre of the band to its nearest feature cell
+        band_lat = lat_radians[rows][:, None]
+        a = np.sin((nearest_lat - band_lat) / 2) ** 2 + np.cos(band_lat) * np.cos(nearest_lat) * np.sin((nearest_lon - lon_radians) / 2) ** 2
+        distance = (2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0, 1)))).astype(np.float32)
+        if max_distance is not None:
+            distance[distance > max_distance] = np.inf
+        output[rows] = distance
+        near += 1
+    return near
+
+def buffer_mask(distance, buffer_distance):
+    """
+    Mark the cells within a buffer distance of the features of a distance layer.
+
+    Parameters:
+    - distance: Distance layer in km, see `distance_to_features`.
+    - buffer_distance: Buffer distance in km, at most the max_distance of the layer.
+
+    Returns:
+    - uint8 mask, 1 within the buffer and 0 elsewhere.
+    """
+    return (distance <= buffer_distance).astype(np.uint8)
+
+def write_distance_layers(specs, output_path, lat, lon, max_distance=max_distance, tile_size=tile_size, complevel=complevel):
+    """
+    Compute the distance layers and stream them band by band into one chunked, compressed NetCDF file.
+
+    Only the boolean feature cells of a layer are kept for the whole grid, so build the layers
+    on the model grid rather than on the fine grids of the constraint masks.
+
+    Parameters:
+    - specs: List of (features file, output variable) tuples.
+    - output_path: Output NetCDF file.
+    - lat: Ascending latitudes of the grid cell centres.
+    - lon: Ascending longitudes of the grid cell centres.
+    - max_distance: Distance in km beyond which cells are stored as inf; None computes every distance.
+    - tile_size: Rows and columns rasterized at once, and the chunk size of the output.
+    - complevel: zlib compression level.
+
+    Returns:
+    - List of the float32 (lat, lon) distance variables written, in km.
+    """
+    chunk_sizes = (min(tile_size, len(lat)), min(tile_size, len(lon)))
+    with Dataset(output_path, 'w') as output:
+        create_grid(output, lat, lon)
+        if max_distance is not None:
+            output.max_distance = max_distance
+        for source, variable in specs:
+            nc_variable = output.createVariable(variable, np.float32, ('lat', 'lon'), zlib=True, complevel=complevel,
+                                                chunksizes=chunk_sizes)
+            nc_variable.setncatts({'long_name': f"Distance to the nearest {os.path.basename(source)} feature", 'units': 'km'})
+            cells = feature_cells(load_features(source), lat, lon, tile_size)
+            distance_to_features(cells, lat, lon, nc_variable, max_distance)
+    return [variable for _, variable in specs]
 
 # Airport Mask Creation
 
-# Adjusting Latitudes and Longitudes to Grid Points
-def round_to_grid(value, grid_start, increment):
-    increments_from_start = (value - grid_start) / increment
-    rounded_increments = round(increments_from_start)
-    return grid_start + (rounded_increments * increment)
-
-def adjust_to_grid(csv_filepath):
-    df = pd.read_csv(csv_filepath)
-    df['Latitude'] = df['latitude_deg'].apply(lambda x: round_to_grid(x, 22.05, 0.1))
-    df['Longitude'] = df['longitude_deg'].apply(lambda x: round_to_grid(x, -44.5, 0.1))
-    df.drop(['latitude_deg', 'longitude_deg'], axis=1, inplace=True)
-    return df[['ident', 'name', 'Latitude', 'Longitude']]
-
-# Processing CSV file and creating airport mask
-csv_filepath = os.path.join(airport_file_directory, 'scotland_airports.csv')
-adjusted_df = adjust_to_grid(csv_filepath)
-airports_directory = os.path.join(airport_file_directory)
-adjusted_df.to_excel(os.path.join(airports_directory, 'scotland_airports_grid.xlsx'), index=False)
-
-excel_file = os.path.join(airports_directory, 'scotland_airports_grid.xlsx')
-airports_df = pd.read_excel(excel_file)
-
-# Define the grid boundaries and step size for the airport mask
-min_lat, max_lat, step_lat = 22.05, 72.55, 0.1
-min_lon, max_lon, step_lon = -44.5, 64.9, 0.1
-
-# Calculate the size of the grid
-lat_size = int((max_lat - min_lat) / step_lat) + 1
-lon_size = int((max_lon - min_lon) / step_lon) + 1
-airport_array = np.zeros((lat_size, lon_size))
-
-# Creating the airport mask in a new NetCDF file
-airport_array = np.zeros((lat_size, lon_size))
-
-for _, row in airports_df.iterrows():
-    lat, lon = row['Latitude'], row['Longitude']
-    lat_idx = int((lat - min_lat) / step_lat)
-    lon_idx = int((lon - min_lon) / step_lon)
-
-    if 0 <= lat_idx < lat_size and 0 <= lon_idx < lon_size:
-        airport_array[lat_idx, lon_idx] = 1
-
-new_netcdf_file = os.path.join(airport_file_directory, "airport_mask.nc")
-
-with Dataset(new_netcdf_file, 'w') as new_nc:
-    new_nc.createDimension('lat', lat_size)
-    new_nc.createDimension('lon', lon_size)
-
-    latitudes = new_nc.createVariable('latitude', np.float32, ('lat',))
-    longitudes = new_nc.createVariable('longitude', np.float32, ('lon',))
-    latitudes[:] = np.linspace(min_lat, max_lat, lat_size)
-    longitudes[:] = np.linspace(min_lon, max_lon, lon_size)
-
-    airport_var = new_nc.createVariable('airport', airport_array.dtype, ('lat', 'lon'))
-    airport_var[:] = airport_array
-    airport_var.units = '1 if airport exists else 0'
-    airport_var.long_name = 'Airport grid presence'
-
-print("Rasterization and conversion to NetCDF for NSA, SPA, and airport mask completed.")
\ No newline at end of file
+def create_airport_mask(csv_filepath=None, output_path=None, point_columns=point_columns):
+    """
+    Count the airports of a CSV file in every cell of the target grid and save them as the airport mask.
+
+    Parameters:
+    - csv_filepath: CSV file of the airports; scotland_airports.csv by default.
+    - output_path: Output NetCDF file; airport_mask.nc by default.
+    - point_columns: (latitude, longitude) columns of the CSV file, in degrees.
+
+    Returns:
+    - int32 array of the number of airports in each cell.
+    """
+    csv_filepath = csv_filepath or os.path.join(airport_file_directory, 'scotland_airports.csv')
+    output_path = output_path or os.path.join(airport_file_directory, "airport_mask.nc")
+
+    # All airports are assigned to their grid cell at once and counted with one scatter-add
+    airports_df = pd.read_csv(csv_filepath)
+    lat_column, lon_column = point_columns
+    lat, lon = target_grid()
+    airport_array = point_counts(airports_df[lat_column], airports_df[lon_column], lat, lon)
+
+    with Dataset(output_path, 'w') as new_nc:
+        new_nc.createDimension('lat', len(lat))
+        new_nc.createDimension('lon', len(lon))
+
+        latitudes = new_nc.createVariable('latitude', np.float32, ('lat',))
+        longitudes = new_nc.createVariable('longitude', np.float32, ('lon',))
+        latitudes[:] = lat
+        longitudes[:] = lon
+
+        airport_var = new_nc.createVariable('airport', airport_array.dtype, ('lat', 'lon'))
+        airport_var[:] = airport_array
+        airport_var.units = 'Number of airports in the grid cell'
+        airport_var.long_name = 'Airport grid presence'
+    return airport_array
+
+def main():
+    parser = argparse.ArgumentParser(description="Rasterize the constraint layers and create the airport mask.")
+    parser.add_argument('--resolution', type=float, default=resolution, help="Grid step in degrees of the constraint masks.")
+    parser.add_argument('--output', default=constraint_mask_file_path, help="Output NetCDF file of the constraint masks.")
+    parser.add_argument('--tile-size', type=int, default=tile_size, help="Rows and columns rasterized at once.")
+    parser.add_argument('--workers', type=int, default=workers, help="Number of worker processes rasterizing tiles.")
+    parser.add_argument('--coverage', action='store_true',
+                        help="Store the fraction of each cell covered by each layer instead of burning every touched cell, "
+                             "for final.py --protected-area-coverage.")
+    parser.add_argument('--supersample', type=int, default=coverage_supersample,
+                        help="Sub-cells per cell side sampled for the coverage fractions.")
+    parser.add_argument('--distance-layers', action='store_true', default=write_distances,
+                        help="Also write the distance layers, on the model grid whatever the --resolution.")
+    parser.add_argument('--distance-output', default=distance_file_path, help="Output NetCDF file of the distance layers.")
+    parser.add_argument('--max-distance', type=float, default=max_distance,
+                        help="Distance in km up to which the distance layers are computed.")
+    args = parser.parse_args()
+
+    # NSA and SPA Mask Creation
+    # Both constraint layers are rasterized tile by tile straight into one NetCDF file
+    lat, lon = target_grid(resolution=args.resolution)
+    burned = write_layers(constraint_layers, args.output, lat, lon, tile_size=args.tile_size, workers=args.workers,
+                          coverage=args.supersample if args.coverage else None)
+    print(f"Constraint masks ({burned} of {len(grid_tiles((len(lat), len(lon)), args.tile_size))} tiles with constraints) "
+          f"have been saved to NetCDF file at: {args.output}")
+
+    # Distance Layers
+    # Buffers of any size around the features are then a comparison with these distances
+    if args.distance_layers:
+        model_lat, model_lon = target_grid()
+        variables = write_distance_layers(distance_layers, args.distance_output, model_lat, model_lon,
+                                          max_distance=args.max_distance, tile_size=args.tile_size)
+        print(f"Distance layers {', '.join(variables)} have been saved to NetCDF file at: {args.distance_output}")
+
+    create_airport_mask()
+    print("Rasterization and conversion to NetCDF for NSA, SPA, and airport mask completed.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+
+# City-Level Data Analysis
+# Shared by the final_*.py scripts to rank candidate wind farm sites for each city.
+
+# Constants for the city analysis.
+earth_radius_km = 6371.009  # Mean earth radius used by geopy's great_circle (km).
+power_loss_per_1000km = 0.0035  # Fractional power loss per 1000 km.
+days_per_year = 365  # Number of days per year.
+top_n = 10  # Number of locations kept per city.
+
+# Function to calculate power loss over distance
+def calculate_power_loss(power, distance):
+    """
+    Calculate the power loss over a given distance due to transmission losses.
+
+    Works element-wise, so `power` and `distance` may be scalars or NumPy arrays.
+
+    Parameters:
+    - power: The initial power in kilowatts (kW).
+    - distance: The distance over which the power is transmitted (in meters).
+
+    Returns:
+    - The power after accounting for the loss over the given distance.
+    """
+    distance_km = distance / 1000
+    loss_fraction = 1 - (power_loss_per_1000km * (distance_km // 1000))
+    return power * loss_fraction
+
+def haversine_distances(city_lats, city_lons, lat, lon):
+    """
+    Calculate the great circle distance from every city to every grid cell in one batch.
+
+    Parameters:
+    - city_lats: 1D array of city latitudes in degrees.
+    - city_lons: 1D array of city longitudes in degrees.
+    - lat: 1D array of grid latitudes in degrees.
+    - lon: 1D array of grid longitudes in degrees.
+
+    Returns:
+    - Array of shape (city, lat, lon) with distances in kilometers.
+    """
+    city_lats = np.radians(np.asarray(city_lats, dtype=np.float64))[:, None, None]
+    city_lons = np.radians(np.asarray(city_lons, dtype=np.float64))[:, None, None]
+    grid_lats = np.radians(np.asarray(lat, dtype=np.float64))[None, :, None]
+    grid_lons = np.radians(np.asarray(lon, dtype=np.float64))[None, None, :]
+
+    # The latitude and longitude terms are separable, so only the final combination is full size
+    sin_dlat = np.sin((grid_lats - city_lats) / 2) ** 2
+    sin_dlon = np.sin((grid_lons - city_lons) / 2) ** 2
+    a = sin_dlat + np.cos(city_lats) * np.cos(grid_lats) * sin_dlon
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def distance_cache_key(city_lats, city_lons, lat, lon):
+    """
+    Build a cache key from the grid coordinates and the city coordinate set.
+
+    Parameters:
+    - city_lats: 1D array of city latitudes in degrees.
+    - city_lons: 1D array of city longitudes in degrees.
+    - lat: 1D array of grid latitudes in degrees.
+    - lon: 1D array of grid longitudes in degrees.
+
+    Returns:
+    - Hex digest that changes whenever any of the coordinates change.
+    """
+    digest = hashlib.sha1()
+    for values in (lat, lon, city_lats, city_lons):
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        digest.update(str(values.shape).encode())
+        digest.update(values.tobytes())
+    return digest.hexdigest()[:16]
+
+def load_distance_matrix(city_lats, city_lons, lat, lon, cache_directory):
+    """
+    Load the (city, lat, lon) distance matrix from disk, computing and storing it on first use.
+
+    The matrix is stored as a float32 .npy file named after `distance_cache_key`, so it is
+    reused across years and scenarios and recomputed automatically when the grid or the city
+    coordinates change. Cached files are opened as read-only memmaps.
+
+    Parameters:
+    - city_lats: 1D array of city latitudes in degrees.
+    - city_lons: 1D array of city longitudes in degrees.
+    - lat: 1D array of grid latitudes in degrees.
+    - lon: 1D array of grid longitudes in degrees.
+    - cache_directory: Directory holding the cached distance matrices.
+
+    Returns:
+    - Array of shape (city, lat, lon) with distances in kilometers.
+    """
+    os.makedirs(cache_directory, exist_ok=True)
+    key = distance_cache_key(city_lats, city_lons, lat, lon)
+    cache_file_path = os.path.join(cache_directory, f"city_distances_{key}.npy")
+
+    if not os.path.exists(cache_file_path):
+        distances = haversine_distances(city_lats, city_lons, lat, lon).astype(np.float32)
+        # Write to a temporary file first so an interrupted run never leaves a partial cache
+        temp_file_path = f"{cache_file_path}.{os.getpid()}.tmp"
+        with open(temp_file_path, 'wb') as f:
+            np.save(f, distances)
+        os.replace(temp_file_path, cache_file_path)
+        print(f"Distance matrix cached at {cache_file_path}")
+
+    return np.load(cache_file_path, mmap_mode='r')
+
+class ResultAccumulator:
+    """
+    Collect result rows as columnar record batches and build the table once at the end.
+
+    Growing a DataFrame with pd.concat for every row or city is quadratic in the number of
+    rows, so batches are kept as dictionaries of column arrays and only concatenated when
+    `to_frame` is called.
+    """
+
+    def __init__(self):
+        self.columns = []
+        self.batches = []
+
+    def append(self, batch):
+        """
+        Add a record batch.
+
+        Parameters:
+        - batch: DataFrame or dictionary of column name -> array or scalar. Scalars are
+          repeated to the length of the array columns.
+        """
+        if isinstance(batch, pd.DataFrame):
+            batch = {name: batch[name].to_numpy() for name in batch.columns}
+        lengths = [len(value) for value in batch.values() if np.ndim(value) == 1]
+        if not lengths:
+            raise ValueError("A record batch needs at least one array column")
+        length = lengths[0]
+        if length == 0:
+            return
+        for name in batch:
+            if name not in self.columns:
+                self.columns.append(name)
+        self.batches.append({
+            name: np.asarray(value) if np.ndim(value) == 1 else np.full(length, value, dtype=object)
+            for name, value in batch.items()
+        })
+
+    def __len__(self):
+        return sum(len(next(iter(batch.values()))) for batch in self.batches)
+
+    def to_frame(self):
+        """
+        Concatenate all record batches into a single DataFrame.
+
+        Returns:
+        - DataFrame with one column per name seen in any batch, in first-seen order.
+        """
+        if not self.batches:
+            return pd.DataFrame()
+        data = {}
+        for name in self.columns:
+            parts = []
+            for batch in self.batches:
+                if name in batch:
+                    parts.append(batch[name])
+                else:
+                    parts.append(np.full(len(next(iter(batch.values()))), np.nan, dtype=object))
+            data[name] = pd.Series(np.concatenate(parts)).infer_objects()
+        return pd.DataFrame(data)
+
+def top_k_indices(values, k):
+    """
+    Select the indices of the k largest values in O(N) using np.argpartition.
+
+    Ties are broken deterministically by the lowest index, which matches a stable
+    descending sort over row-major grid order.
+
+    Parameters:
+    - values: 1D array of candidate scores (no NaN).
+    - k: Number of indices to return.
+
+    Returns:
+    - Array of at most k indices ordered from the largest value to the smallest.
+    """
+    values = np.asarray(values)
+    if k <= 0 or values.size == 0:
+        return np.empty(0, dtype=np.intp)
+    if k < values.size:
+        # Keep every value tied with the k-th largest so the tie-break does not depend on the partition
+        threshold = values[np.argpartition(values, values.size - k)[values.size - k]]
+        candidates = np.flatnonzero(values >= threshold)
+    else:
+        candidates = np.arange(values.size)
+    order = np.lexsort((candidates, -values[candidates]))[:k]
+    return candidates[order]
+
+def _city_table(year, city_name, city_energy_demand_annual, lats, lons, distance, adjusted_daily_power, max_annual_output):
+    """
+    Build the ranked rows for one city from column arrays.
+
+    Returns:
+    - Dictionary of column name -> array (or scalar) with one row per location, in rank order.
+    """
+    annual_energy_production = (adjusted_daily_power * (0.3*24)) * days_per_year
+    if city_energy_demand_annual:
+        demand_satisfaction = (annual_energy_production / city_energy_demand_annual) * 100
+    else:
+        demand_satisfaction = np.zeros_like(annual_energy_production)
+    return {
+        'Year': year,
+        'City': city_name,
+        'Rank': np.arange(1, len(adjusted_daily_power) + 1),
+        'Lat': lats,
+        'Lon': lons,
+        'Distance_to_City (km)': distance,
+        'Adjusted_Daily_Power (kW)': adjusted_daily_power,
+        'Annual_Energy_Production (kWh)': annual_energy_production,
+        'City_Energy_Demand (kWh)': city_energy_demand_annual,
+        'Demand_Satisfaction (%)': demand_satisfaction,
+        'Capacity Factor (%)': (annual_energy_production / max_annual_output) * 100
+    }
+
+def _city_top_locations_loop(power_generation, lat, lon, city_coords, k):
+    """
+    Rank grid cells for one city with the original per-pixel great_circle loop.
+
+    Kept as a reference implementation so the vectorized engine can be checked against it.
+
+    Returns:
+    - Tuple of (lats, lons, distance, adjusted_daily_power) arrays in rank order.
+    """
+    from geopy.distance import great_circle
+
+    # List to store all locations with their power generation
+    all_locations = []
+
+    # Iterate over each grid point to find potential locations
+    for i in range(len(lat)):
+        for j in range(len(lon)):
+            daily_power_generation = power_generation[i, j]
+            if daily_power_generation > 0:
+                wind_farm_coords = (lat[i], lon[j])
+                distance = great_circle(wind_farm_coords, city_coords).kilometers
+                adjusted_daily_power = calculate_power_loss(daily_power_generation, distance)
+
+                # Add location and its power generation to the list
+                all_locations.append((adjusted_daily_power, wind_farm_coords, distance))
+
+    # Sort the locations by power generation and select the top k
+    top_locations = sorted(all_locations, key=lambda x: x[0], reverse=True)[:k]
+    return (
+        np.array([location[0] for _, location, _ in top_locations]),
+        np.array([location[1] for _, location, _ in top_locations]),
+        np.array([distance for _, _, distance in top_locations], dtype=np.float64),
+        np.array([power for power, _, _ in top_locations], dtype=np.float64)
+    )
+
+def _city_top_locations_vectorized(power_generation, lat, lon, distances, k):
+    """
+    Rank grid cells for one city from a precomputed (lat, lon) distance array.
+
+    Returns:
+    - Tuple of (lats, lons, distance, adjusted_daily_power) arrays in rank order.
+    """
+    valid = np.flatnonzero(power_generation > 0)
+    distance = np.asarray(distances).ravel()[valid].astype(np.float64)
+    adjusted_daily_power = calculate_power_loss(power_generation.ravel()[valid], distance)
+
+    top = top_k_indices(adjusted_daily_power, k)
+    rows, cols = np.unravel_index(valid[top], power_generation.shape)
+    return np.asarray(lat)[rows], np.asarray(lon)[cols], distance[top], adjusted_daily_power[top]
+
+def city_top_locations(power_generation, lat, lon, energy_demand_df, year, max_annual_output, engine='vectorized', cache_directory=None, k=top_n):
+    """
+    Find the best wind farm locations for every city in the energy demand table.
+
+    Parameters:
+    - power_generation: 2D array (lat, lon) of daily power generation in kW, NaN where missing.
+    - lat: 1D array of grid latitudes.
+    - lon: 1D array of grid longitudes.
+    - energy_demand_df: DataFrame with 'City', 'Latitude', 'Longitude' and 'Energy Demand (kWh)' columns.
+    - year: The year being analysed, copied into the output rows.
+    - max_annual_output: Maximal annual output of a turbine in kWh, used for the capacity factor.
+    - engine: 'vectorized' to use the batched haversine distances, 'loop' for the original great_circle loop.
+    - cache_directory: Optional directory for the persisted distance matrix (vectorized engine only).
+    - k: Number of locations kept per city.
+
+    Returns:
+    - DataFrame with the top locations for every city.
+    """
+    if engine not in ('vectorized', 'loop'):
+        raise ValueError(f"Unknown distance engine: {engine}")
+
+    power_generation = np.asarray(power_generation, dtype=np.float64)
+    if engine == 'vectorized':
+        city_lats = energy_demand_df['Latitude'].to_numpy()
+        city_lons = energy_demand_df['Longitude'].to_numpy()
+        if cache_directory is not None:
+            distances = load_distance_matrix(city_lats, city_lons, lat, lon, cache_directory)
+        else:
+            distances = haversine_distances(city_lats, city_lons, lat, lon)
+
+    # Accumulator to store results
+    top_locations = ResultAccumulator()
+
+    # Iterate over each city
+    for city_idx, (index, row) in enumerate(energy_demand_df.iterrows()):
+        city_name = row['City']
+        city_coords = (row['Latitude'], row['Longitude'])
+        city_energy_demand_annual = row['Energy Demand (kWh)']
+
+        if engine == 'vectorized':
+            ranked = _city_top_locations_vectorized(power_generation, lat, lon, distances[city_idx], k)
+        else:
+            ranked = _city_top_locations_loop(power_generation, lat, lon, city_coords, k)
+
+        top_locations.append(_city_table(year, city_name, city_energy_demand_annual, *ranked, max_annual_output))
+
+    return top_locations.to_frame()
+
+def top_power_locations(power_generation, lat, lon, year, max_annual_output, k=top_n):
+    """
+    Find the grid cells with the highest annual energy production, ignoring city demand.
+
+    Parameters:
+    - power_generation: 2D array (lat, lon) of daily power generation in kW, NaN where missing.
+    - lat: 1D array of grid latitudes.
+    - lon: 1D array of grid longitudes.
+    - year: The year being analysed, copied into the output rows.
+    - max_annual_output: Maximal annual output of a turbine in kWh, used for the capacity factor.
+    - k: Number of locations kept.
+
+    Returns:
+    - DataFrame with the top locations in rank order.
+    """
+    power_generation = np.asarray(power_generation, dtype=np.float64)
+    valid = np.flatnonzero(power_generation > 0)
+    annual_energy_production = power_generation.ravel()[valid] * days_per_year * (0.3 * 24)
+
+    top = top_k_indices(annual_energy_production, k)
+    rows, cols = np.unravel_index(valid[top], power_generation.shape)
+    annual_production = annual_energy_production[top]
+
+    return pd.DataFrame({
+        'Year': year,
+        'Rank': np.arange(1, len(top) + 1),
+        'Lat': np.asarray(lat)[rows],
+        'Lon': np.asarray(lon)[cols],
+        # Calculating back the daily power generation
+        'Daily Power Potential (kW)': annual_production / (days_per_year * 0.3 * 24),
+        'Annual Energy Production (kWh)': annual_production,
+        'Capacity Factor (%)': (annual_production / max_annual_output) * 100
+    })
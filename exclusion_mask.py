@@ -0,0 +1,243 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Exclusion Mask Layer
+# Combines the NSA, airport and SPA rasters from Raster_Layer.py with the urban/water land use
+# classes into one grid-aligned layer. Each cell stores a bit per constraint, so the layer both
+# masks the power generation and records which constraint excluded each cell.
+
+# Bit flags for each constraint.
+NSA = 1  # National Scenic Area.
+AIRPORT = 2  # Airport grid cell.
+SPA = 4  # Special Protection Area.
+URBAN = 8  # Urban land use class.
+WATER = 16  # Water land use class.
+constraints = {'nsa': NSA, 'airport': AIRPORT, 'spa': SPA, 'urban': URBAN, 'water': WATER}
+
+# Groups of flags applied at different stages of the model.
+protected_area_flags = NSA | AIRPORT | SPA
+land_use_flags = URBAN | WATER
+
+# Land use classes excluded from power generation (IPCC classes of land_use_change.ipcc_classes).
+urban_class = 5  # Settlement.
+water_class = 7  # Water.
+excluded_fraction = 0.5  # Urban or water fraction from which a cell is excluded, for land use layers with land_cover_fraction.
+
+layer_version = 3  # Bump when the way the layer is built changes, to invalidate cached layers.
+
+def _hash_file(digest, file_path, block_size=1 << 20):
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+def exclusion_cache_key(grid_ds, nsa_mask_file_path, airport_mask_file_path, spa_mask_file_path, land_use_file_path, coverage=False):
+    """
+    Build a cache key from the model grid and the content of every input file.
+
+    Parameters:
+    - grid_ds: Dataset with the model 'lat' and 'lon' coordinates.
+    - nsa_mask_file_path: NSA raster NetCDF file.
+    - airport_mask_file_path: Airport mask NetCDF file.
+    - spa_mask_file_path: SPA raster NetCDF file.
+    - land_use_file_path: Regridded land use NetCDF file.
+    - coverage: Whether the NSA/SPA bits only mark fully covered cells, see `build_exclusion_layer`.
+
+    Returns:
+    - Hex digest that changes whenever the grid, any input file or the coverage mode changes.
+    """
+    digest = hashlib.sha1(f"{layer_version}{'coverage' if coverage else ''}".encode())
+    for name in ('lat', 'lon'):
+        digest.update(np.ascontiguousarray(grid_ds[name].values, dtype=np.float64).tobytes())
+    for file_path in (nsa_mask_file_path, airport_mask_file_path, spa_mask_file_path, land_use_file_path):
+        _hash_file(digest, file_path)
+    return digest.hexdigest()[:16]
+
+def mask_variable(mask_ds, name):
+    """
+    Return a constraint mask from either the combined constraint_masks.nc of Raster_Layer.py
+    (one variable per constraint) or a single-mask file with a 'mask' variable.
+
+    Parameters:
+    - mask_ds: Mask dataset.
+    - name: Variable of the constraint in the combined file, e.g. 'nsa'.
+    """
+    mask = mask_ds[name] if name in mask_ds else mask_ds['mask']
+    # Scalar coordinates such as the CRS 'spatial_ref' are not carried into the exclusion layer
+    return mask.reset_coords(drop=True)
+
+def build_exclusion_layer(static_ds, nsa_mask_file_path, airport_mask_file_path, spa_mask_file_path, chunks=None, coverage=False):
+    """
+    Build the combined exclusion layer on the grid of the static dataset.
+
+    Parameters:
+    - static_ds: Merged static dataset containing 'lccs_class', and optionally 'land_cover_fraction', on the model grid.
+    - nsa_mask_file_path: NetCDF file with the NSA mask ('nsa' or 'mask' variable).
+    - airport_mask_file_path: Airport mask NetCDF file.
+    - spa_mask_file_path: NetCDF file with the SPA mask ('spa' or 'mask' variable); may be the same file as the NSA mask.
+    - chunks: Optional Dask chunks; the masks are then opened lazily and the layer is not computed.
+    - coverage: Set the NSA/SPA bits only where the masks cover the whole cell, for coverage fraction
+      masks whose partly covered cells are scaled by `available_fraction_layer` instead.
+
+    Returns:
+    - uint8 DataArray named 'exclusion' with one bit set per constraint that excludes the cell.
+    """
+    nsa_mask_ds = xr.open_dataset(nsa_mask_file_path, chunks=chunks)
+    airport_mask_ds = xr.open_dataset(airport_mask_file_path, chunks=chunks)
+    special_mask_ds = xr.open_dataset(spa_mask_file_path, chunks=chunks)
+
+    # Cells are excluded wherever the aligned mask is not exactly 0, as in the original masking
+    masks = [
+        (mask_variable(nsa_mask_ds, 'nsa'), NSA, coverage),
+        (airport_mask_ds['airport'], AIRPORT, False),
+        (mask_variable(special_mask_ds, 'spa'), SPA, coverage)
+    ]
+    exclusion = xr.zeros_like(static_ds['lccs_class'], dtype=np.uint8)
+    for mask, flag, fully_covered in masks:
+        aligned = mask.reindex_like(static_ds, method='nearest')
+        if chunks is None:
+            aligned = aligned.load()
+        excluded = aligned >= 1 if fully_covered else aligned != 0
+        exclusion = exclusion | excluded.astype(np.uint8) * np.uint8(flag)
+
+    exclusion = exclusion | land_use_exclusion(static_ds)
+
+    exclusion = exclusion.astype(np.uint8).rename('exclusion')
+    exclusion.attrs = {
+        'long_name': 'Constraints excluding the cell from power generation',
+        'flag_masks': np.array(list(constraints.values()), dtype=np.uint8),
+        'flag_meanings': ' '.join(constraints)
+    }
+    return exclusion
+
+def available_fraction_layer(static_ds, nsa_mask_file_path, spa_mask_file_path, chunks=None):
+    """
+    Build the share of each cell outside the NSA and SPA from coverage fraction masks
+    (Raster_Layer.py --coverage), to scale the power of partly covered cells.
+
+    The NSA and SPA fractions are added, so cells where both cover the same part count it twice
+    and the available share errs on the low side. Burned 0/1 masks give a share of 0 or 1.
+
+    Parameters:
+    - static_ds: Static dataset with the model 'lat' and 'lon' coordinates.
+    - nsa_mask_file_path: NetCDF file with the NSA mask ('nsa' or 'mask' variable).
+    - spa_mask_file_path: NetCDF file with the SPA mask ('spa' or 'mask' variable); may be the same file as the NSA mask.
+    - chunks: Optional Dask chunks; the masks are then opened lazily and the layer is not computed.
+
+    Returns:
+    - float32 DataArray named 'available_fraction' on the model grid, between 0 and 1.
+    """
+    covered = 0
+    for file_path, name in ((nsa_mask_file_path, 'nsa'), (spa_mask_file_path, 'spa')):
+        mask = mask_variable(xr.open_dataset(file_path, chunks=chunks), name).reindex_like(static_ds, method='nearest')
+        if chunks is None:
+            mask = mask.load()
+        covered = covered + mask.fillna(0).astype(np.float32)
+    available = (1 - covered.clip(0, 1)).astype(np.float32).rename('available_fraction')
+    available.attrs = {'long_name': 'Share of the cell outside the NSA and SPA', 'units': '1'}
+    return available
+
+def land_use_exclusion(static_ds):
+    """
+    Build the urban and water constraints of the exclusion layer from the land use.
+
+    Parameters:
+    - static_ds: Merged static dataset containing 'lccs_class', and optionally 'land_cover_fraction', on the model grid.
+
+    Returns:
+    - uint8 DataArray with the URBAN and WATER bits set where they exclude the cell.
+    """
+    if 'land_cover_fraction' in static_ds:
+        # With fractional land cover a cell is excluded once enough of it is urban or water
+        fractions = static_ds['land_cover_fraction']
+        urban = fractions.sel(ipcc_class=urban_class, drop=True) >= excluded_fraction
+        water = fractions.sel(ipcc_class=water_class, drop=True) >= excluded_fraction
+    else:
+        urban = static_ds['lccs_class'] == urban_class
+        water = static_ds['lccs_class'] == water_class
+    return urban.astype(np.uint8) * np.uint8(URBAN) | water.astype(np.uint8) * np.uint8(WATER)
+
+def update_land_use_exclusion(exclusion, static_ds):
+    """
+    Replace the urban and water constraints of an exclusion layer with those of another land use.
+
+    The NSA, airport and SPA constraints do not depend on the land use and are kept, so the
+    layer of another land use epoch is derived without reading their rasters again.
+
+    Parameters:
+    - exclusion: Exclusion layer from `load_exclusion_layer`.
+    - static_ds: Merged static dataset of the other land use, on the same grid.
+
+    Returns:
+    - uint8 DataArray named 'exclusion' on the model grid.
+    """
+    updated = (exclusion & np.uint8(protected_area_flags)) | land_use_exclusion(static_ds)
+    updated = updated.astype(np.uint8).rename('exclusion')
+    updated.attrs = exclusion.attrs
+    return updated
+
+def load_exclusion_layer(static_ds, nsa_mask_file_path, airport_mask_file_path, spa_mask_file_path, land_use_file_path, cache_directory, chunks=None,
+                         coverage=False):
+    """
+    Load the exclusion layer from the cache, building and storing it if the inputs changed.
+
+    Parameters:
+    - static_ds: Merged static dataset containing 'lccs_class' on the model grid.
+    - nsa_mask_file_path: NSA raster NetCDF file.
+    - airport_mask_file_path: Airport mask NetCDF file.
+    - spa_mask_file_path: SPA raster NetCDF file.
+    - land_use_file_path: Regridded land use NetCDF file the 'lccs_class' was read from.
+    - cache_directory: Directory holding the cached exclusion layers.
+    - chunks: Optional Dask chunks; the layer is then written chunk by chunk and returned lazily.
+    - coverage: Set the NSA/SPA bits only for fully covered cells, see `build_exclusion_layer`.
+
+    Returns:
+    - uint8 DataArray named 'exclusion' on the model grid.
+    """
+    os.makedirs(cache_directory, exist_ok=True)
+    key = exclusion_cache_key(static_ds, nsa_mask_file_path, airport_mask_file_path, spa_mask_file_path, land_use_file_path, coverage)
+    cache_file_path = os.path.join(cache_directory, f"exclusion_{key}.nc")
+
+    if not os.path.exists(cache_file_path):
+        exclusion = build_exclusion_layer(static_ds, nsa_mask_file_path, airport_mask_file_path, spa_mask_file_path, chunks=chunks,
+                                          coverage=coverage)
+        # Write to a temporary file first so an interrupted run never leaves a partial cache
+        temp_file_path = f"{cache_file_path}.{os.getpid()}.tmp"
+        exclusion.to_dataset().to_netcdf(temp_file_path, encoding={'exclusion': {'zlib': True, 'complevel': 4}})
+        os.replace(temp_file_path, cache_file_path)
+        print(f"Exclusion layer cached at {cache_file_path}")
+        if chunks is None:
+            return exclusion
+
+    if chunks is not None:
+        exclusion = xr.open_dataset(cache_file_path, chunks=chunks)['exclusion']
+    else:
+        with xr.open_dataset(cache_file_path) as ds:
+            exclusion = ds['exclusion'].load()
+    print(f"Exclusion layer loaded from {cache_file_path}")
+    return exclusion
+
+def exclusion_statistics(exclusion):
+    """
+    Count the cells excluded by each constraint.
+
+    Parameters:
+    - exclusion: Exclusion layer from `load_exclusion_layer`.
+
+    Returns:
+    - DataFrame with, per constraint, the number of cells it excludes, the number of cells
+      excluded by that constraint alone and the excluded share of the grid.
+    """
+    values = np.asarray(exclusion.values)
+    rows = []
+    for name, flag in constraints.items():
+        excluded = int(np.count_nonzero(values & flag))
+        rows.append({
+            'Constraint': name,
+            'Excluded Cells': excluded,
+            'Only Constraint Cells': int(np.count_nonzero(values == flag)),
+            'Excluded Share (%)': excluded / values.size * 100
+        })
+    return pd.DataFrame(rows)
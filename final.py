@@ -0,0 +1,809 @@
+# Section 1: Imports and Setup
+
+# Subsection 1.1: Importing Required Libraries
+import argparse
+import multiprocessing
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import xarray as xr
+import numpy as np
+import os
+import pandas as pd
+import simplekml
+from city_analysis import ResultAccumulator, city_top_locations, top_power_locations
+from fused_kernel import fused_power_generation
+from exclusion_mask import (available_fraction_layer, exclusion_statistics, land_use_flags, load_exclusion_layer, protected_area_flags,
+                            update_land_use_exclusion)
+from land_use_change import effective_friction_coefficient
+from power_curve import build_lookup_table, evaluate_power_curves, rated_power, turbine_models
+
+# Subsection 1.2: Directory Setup
+# Define the base directory for the project and subdirectories for various data categories.
+base_directory = '/Users/jamesquessy/Developer/Projects/Masters'
+population_directory = os.path.join(base_directory, 'Data/Population')
+raster_file_directory = os.path.join(base_directory, 'Data/Raster_Data/Raw_Data')
+distance_cache_directory = os.path.join(base_directory, 'Data/Cache/City_Distances')
+cache_directory = os.path.join(base_directory, 'Data/Cache')
+exclusion_cache_directory = os.path.join(base_directory, 'Data/Cache/Exclusion')
+
+
+# Define file paths for orography, land area, and land use data.
+orography_file_path = os.path.join(base_directory, 'Data/Raster_Data/Orogrophy/orography_remap.nc')
+land_area_file_path = os.path.join(base_directory, 'Data/Raster_Data/Land_Area/land_area_remap.nc')
+land_use_file_path = os.path.join(base_directory, 'Data/Raster_Data/land_use/remaped_land.nc')
+# Land use of each land cover epoch, written by land_use_pipeline.py --epoch.
+land_use_epoch_file_pattern = os.path.join(base_directory, 'Data/Raster_Data/land_use/remaped_land_{epoch}.nc')
+
+# Define file paths for raster files.
+# The NSA and SPA masks are variables of the combined constraint mask file written by Raster_Layer.py.
+airport_mask_file_path = os.path.join(raster_file_directory, 'airport_mask.nc')
+spa_mask_file_path = os.path.join(raster_file_directory, 'constraint_masks.nc')
+nsa_mask_file_path = os.path.join(raster_file_directory, 'constraint_masks.nc')
+
+def scenario_directories(rcp):
+    """
+    Build the scenario specific directories for an RCP scenario and make sure they exist.
+
+    Parameters:
+    - rcp: The RCP scenario as a string, e.g. '4.5'.
+
+    Returns:
+    - Dictionary with the 'last_year_avg', 'merged', 'final_files' and 'output' directories.
+    """
+    directories = {
+        'last_year_avg': os.path.join(base_directory, f'Data/last_year_avg/RCP_{rcp}'),
+        'merged': os.path.join(base_directory, f'RCP_{rcp}/Code/Merged_Files'),
+        'final_files': os.path.join(base_directory, f'RCP_{rcp}/Code/final_files'),
+        'output': os.path.join(base_directory, f'RCP_{rcp}/Code')
+    }
+    for directory in directories.values():
+        os.makedirs(directory, exist_ok=True)
+    return directories
+
+
+# Subsection 1.3: Define Constants for the Model
+# Define scenarios, years for analysis and variables for climate data.
+scenarios = ['2.6', '4.5', '8.5']
+years = ['2020', '2050', '2075', '2099']
+variables = ['hurs', 'ps', 'sfcWind', 'tas']
+
+# Constants related to wind turbine calculations.
+turbine_area = 2000  # Turbine area in square meters.
+power_coefficient = 0.35  # Turbine power coefficient.
+reference_height = 10  # Reference height for wind speed measurement (in meters).
+target_height = 80  # Target height for wind speed estimation (in meters).
+
+# Physical constants and other parameters for environmental calculations.
+Rd = 287.05  # Specific gas constant for dry air (J/kg·K).
+Rv = 461.5  # Specific gas constant for water vapor (J/kg·K).
+Kelvin = 273.15  # Conversion constant from Celsius to Kelvin.
+hours_per_year = 8760  # Number of hours in a non-leap year.
+air_density = 1.225  # Air density at sea level (kg/m³).
+swept_area = 2000  # Area swept by wind turbine blades (m²).
+rated_wind_speed = 14  # Rated wind speed for turbine power calculations (m/s).
+distance_engine = 'vectorized'  # City distance engine: 'vectorized' or 'loop' (original great_circle loop).
+top_k = 10  # Number of top locations kept per city and year.
+workers = 1  # Number of worker processes for the scenario/year jobs (1 runs them serially).
+debug_outputs = False  # Save the intermediate Merged_{year}.nc and essential_var_{year}.nc files.
+power_kernel = 'numpy'  # Power generation kernel: 'numpy' (separate formulas), 'fused' or 'fused-float32'.
+chunks = None  # Dask chunks for the chunked execution mode, e.g. {'lat': 500, 'lon': 500}; None loads eagerly.
+wind_statistic = 'mean'  # Wind speed cubed for the power: 'mean' (annual mean sfcWind), 'cubed_mean' or 'weibull'.
+turbines = None  # Turbine models from power_curve.turbine_models, e.g. ['model']; None uses the unbounded power formula.
+roughness_average = 'log'  # Friction coefficient of mixed land use cells with land_cover_fraction: 'log' or 'area' average.
+land_use_epochs = []  # Land cover epochs, e.g. [2015, 2020]; each year uses the nearest one. Empty uses remaped_land.nc for every year.
+protected_area_coverage = False  # Scale the power of cells partly in an NSA/SPA by their uncovered share instead of zeroing it (needs Raster_Layer.py --coverage masks).
+
+# Variables of the sfcWind_{year}_wind_moments.nc files from last_year_avg.py holding the mean of v³ for each wind statistic.
+wind_moment_variables = {'cubed_mean': 'sfcWind_cubed_mean', 'weibull': 'sfcWind_weibull_cubed_mean'}
+
+# Section 2: Wind Turbine Weather Analysis
+
+# Subsection 2.1: Function Definitions for Various Wind Calculations
+
+def calculate_wind_at_80m(wind_speed_10m, friction_coefficient, reference_height, target_height):
+    """
+    Calculate wind speed at 80 meters using logarithmic wind profile.
+
+    Parameters:
+    - wind_speed_10m: Wind speed measured at 10 meters.
+    - friction_coefficient: Surface friction coefficient.
+    - reference_height: The height at which the reference wind speed is measured.
+    - target_height: The height for which the wind speed is to be estimated.
+
+    Returns:
+    - Estimated wind speed at 80 meters.
+    """
+    return wind_speed_10m * (np.log(target_height / friction_coefficient) / np.log(reference_height / friction_coefficient))
+
+def calculate_saturation_vapor_pressure(t):
+    """
+    Calculate saturation vapor pressure based on temperature.
+
+    Parameters:
+    - t: Temperature in degrees Celsius.
+
+    Returns:
+    - Saturation vapor pressure in Pascals.
+    """
+    return 6.1094 * np.exp((17.625 * t) / (t + 243.04)) * 100
+
+def calculate_vapor_pressure(t, rh):
+    """
+    Calculate actual vapor pressure based on temperature and relative humidity.
+
+    Parameters:
+    - t: Temperature in degrees Celsius.
+    - rh: Relative humidity in percentage.
+
+    Returns:
+    - Actual vapor pressure in Pascals.
+    """
+    es = calculate_saturation_vapor_pressure(t)
+    return (rh / 100.0) * es
+
+def calculate_air_density(ps, tas, rh, Rd, Rv, Kelvin):
+    """
+    Calculate air density at surface level.
+
+    Parameters:
+    - ps: Surface pressure in Pascals.
+    - tas: Air temperature in Kelvin.
+    - rh: Relative humidity in percentage.
+    - Rd: Specific gas constant for dry air (J/kg·K).
+    - Rv: Specific gas constant for water vapor (J/kg·K).
+    - Kelvin: Conversion constant from Celsius to Kelvin.
+
+    Returns:
+    - Air density at the surface level in kg/m³.
+    """
+    temp_celsius = tas - Kelvin
+    e = calculate_vapor_pressure(temp_celsius, rh)
+    Pd = ps - e
+    return (Pd / (Rd * tas)) + (e / (Rv * tas))
+
+def calculate_power_generation(wind_80m, air_density, turbine_area, power_coefficient):
+    """
+    Calculate power generation for a single wind turbine.
+
+    Parameters:
+    - wind_80m: Wind speed at 80 meters.
+    - air_density: Air density in kg/m³.
+    - turbine_area: Area covered by the wind turbine in square meters.
+    - power_coefficient: Power coefficient of the turbine.
+
+    Returns:
+    - Power generation in kilowatts.
+    """
+    wind_power = 0.5 * air_density * turbine_area * (wind_80m ** 3) * power_coefficient
+    return wind_power / 1000  # Convert to kW
+
+def calculate_cubic_mean_wind_speed(cubed_mean):
+    """
+    Calculate the wind speed whose cube is the mean of the cubed wind speed.
+
+    Using it in place of the mean wind speed gives the expected power, since the power grows
+    with v³ and the mean of v³ is larger than the cube of the mean wind speed.
+
+    Parameters:
+    - cubed_mean: Mean of the cubed wind speed (m³/s³).
+
+    Returns:
+    - Cubic mean wind speed (m/s).
+    """
+    return np.cbrt(cubed_mean)
+
+
+# Section 3: Static Layers
+
+def nearest_epoch(year, epochs):
+    """
+    Return the land use epoch closest to a model year; ties go to the earlier epoch.
+
+    Parameters:
+    - year: The model year.
+    - epochs: The land use epochs.
+    """
+    return min(sorted(epochs, key=int), key=lambda epoch: abs(int(epoch) - int(year)))
+
+def load_static_layers(chunks=None, land_use_epochs=land_use_epochs, coverage=protected_area_coverage):
+    """
+    Load the layers that do not depend on the scenario or the year.
+
+    Orography, land area and land use are merged once, and the NSA, airport, SPA and
+    urban/water constraints are combined into a cached exclusion layer on that grid, so
+    every scenario and year can reuse them. When the land use layer has the fraction of each
+    class per cell (land_use_pipeline.py), the friction coefficient averages the classes in
+    the cell and the urban/water constraints use their fractions.
+
+    With land use epochs, the land use of every epoch is merged with the same orography and land
+    area, and the exclusion layers of the later epochs are derived from the first one by only
+    replacing the urban/water constraints.
+
+    Parameters:
+    - chunks: Optional Dask chunks, e.g. {'lat': 500, 'lon': 500}. The layers are then opened
+      lazily and every later step of the model runs chunk by chunk.
+    - land_use_epochs: Land cover epochs whose files follow land_use_epoch_file_pattern; empty
+      uses land_use_file_path.
+    - coverage: Read the NSA/SPA masks as coverage fractions: only fully covered cells are
+      excluded and an 'available_fraction' layer scales the power of the others.
+
+    Returns:
+    - Dictionary with the merged static 'dataset', the 'exclusion' layer and the 'chunks' used,
+      plus the 'available_fraction' layer with coverage.
+      With land use epochs these are the layers of the first epoch, and 'epochs' maps every
+      epoch to its own dictionary of layers (see `static_layers_for_year`).
+    """
+    orography_ds = xr.open_dataset(orography_file_path, chunks=chunks)
+    land_area_ds = xr.open_dataset(land_area_file_path, chunks=chunks)
+    base_ds = xr.merge([orography_ds, land_area_ds])
+
+    if land_use_epochs:
+        land_use_files = {epoch: land_use_epoch_file_pattern.format(epoch=epoch) for epoch in sorted(land_use_epochs, key=int)}
+    else:
+        land_use_files = {None: land_use_file_path}
+
+    epoch_layers = {}
+    for epoch, file_path in land_use_files.items():
+        land_use_ds = xr.open_dataset(file_path, chunks=chunks)
+        static_ds = xr.merge([base_ds, land_use_ds])
+        if 'land_cover_fraction' in static_ds:
+            if chunks is not None:
+                # The classes are averaged per cell, so each chunk needs all of them
+                static_ds['land_cover_fraction'] = static_ds['land_cover_fraction'].chunk({'ipcc_class': -1})
+            static_ds['friction_coefficient'] = xr.apply_ufunc(
+                effective_friction_coefficient, static_ds['land_cover_fraction'], input_core_dims=[['ipcc_class']],
+                kwargs={'classes': static_ds['ipcc_class'].values, 'method': roughness_average},
+                dask='parallelized', output_dtypes=[np.float64]
+            )
+        if chunks is None:
+            static_ds = static_ds.load()
+
+        if not epoch_layers:
+            exclusion = load_exclusion_layer(static_ds, nsa_mask_file_path, airport_mask_file_path, spa_mask_file_path,
+                                             file_path, exclusion_cache_directory, chunks=chunks, coverage=coverage)
+        else:
+            # Only the urban/water constraints depend on the land use epoch
+            exclusion = update_land_use_exclusion(next(iter(epoch_layers.values()))['exclusion'], static_ds)
+        if epoch is not None:
+            print(f"Land use epoch {epoch}:")
+        print(exclusion_statistics(exclusion).to_string(index=False))
+
+        epoch_layers[epoch] = {
+            'dataset': static_ds,
+            'exclusion': exclusion,
+            'chunks': chunks
+        }
+        if coverage:
+            # The NSA/SPA coverage does not depend on the land use epoch
+            first_layers = next(iter(epoch_layers.values()))
+            if 'available_fraction' not in first_layers:
+                first_layers['available_fraction'] = available_fraction_layer(static_ds, nsa_mask_file_path, spa_mask_file_path,
+                                                                              chunks=chunks)
+            epoch_layers[epoch]['available_fraction'] = first_layers['available_fraction']
+
+    static_layers = dict(next(iter(epoch_layers.values())))
+    if land_use_epochs:
+        static_layers['epochs'] = epoch_layers
+    print("Static layers loaded")
+    return static_layers
+
+def static_layers_for_year(static_layers, year):
+    """
+    Select the static layers of the land use epoch nearest to a year.
+
+    Parameters:
+    - static_layers: Static layers from `load_static_layers` or `attach_static_layers`.
+    - year: The model year.
+
+    Returns:
+    - The static layers to use for the year; the layers themselves without land use epochs.
+    """
+    if 'epochs' not in static_layers:
+        return static_layers
+    epoch = nearest_epoch(year, static_layers['epochs'])
+    print(f"Land use epoch {epoch} used for {year}")
+    return static_layers['epochs'][epoch]
+
+
+# Section 4: Data Processing and Analysis
+
+def merge_datasets(year, directories, static_layers, debug_outputs=False, power_kernel=power_kernel, wind_statistic=wind_statistic,
+                   turbines=turbines):
+    """
+    Merge the static layers with the climate datasets for a given year and apply the masks.
+
+    Parameters:
+    - year: The year for which the datasets are to be merged.
+    - directories: Scenario directories from `scenario_directories`.
+    - static_layers: Static layers from `load_static_layers`.
+    - debug_outputs: Also save the merged dataset as Merged_{year}.nc.
+    - power_kernel: 'numpy' to add wind_80m, air_density and power_generation with the separate
+      formulas, or 'fused'/'fused-float32' to compute only power_generation with the fused kernel.
+    - wind_statistic: 'mean' to use the annual mean sfcWind, or 'cubed_mean'/'weibull' to use the
+      cubic mean wind speed from sfcWind_{year}_wind_moments.nc (last_year_avg.py --moments),
+      measured or from the fitted Weibull distribution, for the expected power.
+    - turbines: Turbine models whose power curves replace the unbounded formula, evaluated
+      together in one pass. power_generation holds the first model; with several models
+      power_generation_by_turbine holds all of them. None uses the unbounded formula.
+
+    Returns:
+    - The merged dataset, in memory.
+
+    Steps:
+    1. Start from the static datasets (orography, land area, and land use).
+    2. Append additional climate data for the specified year.
+    3. Calculate wind speed at 80m, air density, and power generation.
+    4. Apply the NSA, airport and SPA masks to the power generation data, scaling partly
+       covered cells by their available fraction when the static layers have one.
+    5. Optionally save the merged dataset as a NetCDF file.
+    """
+    datasets = [static_layers['dataset']]
+    chunks = static_layers.get('chunks')
+
+    # Append additional climate data for the specified year
+    for variable in variables:
+        file_path = os.path.join(directories['last_year_avg'], f"{variable}_{year}_yearly_avg.nc")
+        if os.path.exists(file_path):
+            ds = xr.open_dataset(file_path, chunks=chunks)
+            if 'height' in ds:
+                ds = ds.drop_vars('height')  # Drop 'height' variable if present
+            datasets.append(ds)
+
+    # Append the wind distribution statistics for the expected power
+    if wind_statistic != 'mean':
+        file_path = os.path.join(directories['last_year_avg'], f"sfcWind_{year}_wind_moments.nc")
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"{file_path} not found, run last_year_avg.py with --moments for the '{wind_statistic}' wind statistic")
+        ds = xr.open_dataset(file_path, chunks=chunks)
+        if 'height' in ds:
+            ds = ds.drop_vars('height')  # Drop 'height' variable if present
+        datasets.append(ds[[wind_moment_variables[wind_statistic]]])
+
+    # Merge all datasets and calculate necessary parameters
+    merged_ds = xr.merge(datasets)
+    wind_input = 'sfcWind'
+    if wind_statistic != 'mean':
+        merged_ds['sfcWind_cubic_mean'] = calculate_cubic_mean_wind_speed(merged_ds[wind_moment_variables[wind_statistic]])
+        wind_input = 'sfcWind_cubic_mean'
+    kernel_inputs = [wind_input, 'friction_coefficient', 'ps', 'tas', 'hurs']
+    if power_kernel != 'numpy' and not turbines and all(name in merged_ds for name in kernel_inputs):
+        dtype = np.float32 if power_kernel == 'fused-float32' else np.result_type(*(merged_ds[name].dtype for name in kernel_inputs))
+        merged_ds['power_generation'] = xr.apply_ufunc(
+            fused_power_generation, *(merged_ds[name] for name in kernel_inputs),
+            kwargs={
+                'reference_height': reference_height, 'target_height': target_height, 'Rd': Rd, 'Rv': Rv, 'Kelvin': Kelvin,
+                'turbine_area': turbine_area, 'power_coefficient': power_coefficient, 'dtype': dtype
+            },
+            dask='parallelized', output_dtypes=[dtype]
+        )
+    if wind_input in merged_ds and 'friction_coefficient' in merged_ds and 'power_generation' not in merged_ds:
+        merged_ds['wind_80m'] = calculate_wind_at_80m(
+            merged_ds[wind_input], merged_ds['friction_coefficient'], reference_height, target_height
+        )
+    if 'ps' in merged_ds and 'tas' in merged_ds and 'hurs' in merged_ds and 'power_generation' not in merged_ds:
+        merged_ds['air_density'] = calculate_air_density(
+            merged_ds['ps'], merged_ds['tas'], merged_ds['hurs'], Rd, Rv, Kelvin
+        )
+    if 'wind_80m' in merged_ds and 'air_density' in merged_ds and turbines:
+        # Evaluate the power curves of all turbine models in one batched lookup
+        power_by_turbine = xr.apply_ufunc(
+            evaluate_power_curves, merged_ds['wind_80m'], merged_ds['air_density'],
+            kwargs={'lookup_table': build_lookup_table(turbines)},
+            output_core_dims=[['turbine']], dask='parallelized', output_dtypes=[np.float32],
+            dask_gufunc_kwargs={'output_sizes': {'turbine': len(turbines)}}
+        ).assign_coords(turbine=list(turbines))
+        merged_ds['power_generation'] = power_by_turbine.isel(turbine=0, drop=True)
+        if len(turbines) > 1:
+            merged_ds['power_generation_by_turbine'] = power_by_turbine
+    elif 'wind_80m' in merged_ds and 'air_density' in merged_ds:
+        merged_ds['power_generation'] = calculate_power_generation(
+            merged_ds['wind_80m'], merged_ds['air_density'], turbine_area, power_coefficient
+        )
+
+    # The exclusion layer is already on the static grid, so this is a no-op unless the climate grid differs
+    exclusion = static_layers['exclusion'].reindex_like(merged_ds['power_generation'], method='nearest')
+
+    available = static_layers.get('available_fraction')
+    if available is not None:
+        available = available.reindex_like(merged_ds['power_generation'], method='nearest')
+
+    # Apply NSA, airport, and SPA masks together
+    for name in ('power_generation', 'power_generation_by_turbine'):
+        if name in merged_ds:
+            merged_ds[name] = merged_ds[name].where((exclusion & protected_area_flags) == 0, 0)
+            if available is not None:
+                # Cells partly in an NSA or SPA keep the power of their uncovered share
+                merged_ds[name] = merged_ds[name] * available
+
+    # Save the merged dataset
+    if debug_outputs:
+        merged_file_path = os.path.join(directories['merged'], f"Merged_{year}.nc")
+        merged_ds.to_netcdf(merged_file_path)
+        print(f"Merged file for {year} saved at {merged_file_path}")
+
+    return merged_ds
+
+# Section 5: Data Processing and Analysis for Each Year
+
+def process_year(year, directories, static_layers, debug_outputs=False, power_kernel=power_kernel, wind_statistic=wind_statistic,
+                 turbines=turbines):
+    """
+    Run the merge, variable selection, land use masking and NaN replacement for one year.
+
+    The whole chain runs on the in-memory dataset and only the final file is written. When the
+    static layers were loaded with chunks, the chain stays lazy: the final file is streamed to
+    disk chunk by chunk and reopened lazily, so peak memory is bounded by the chunk size.
+
+    Parameters:
+    - year: The year to process.
+    - directories: Scenario directories from `scenario_directories`.
+    - static_layers: Static layers from `load_static_layers`.
+    - debug_outputs: Also save the intermediate Merged_{year}.nc and essential_var_{year}.nc files.
+    - power_kernel: Power generation kernel, see `merge_datasets`.
+    - wind_statistic: Wind speed statistic used for the power, see `merge_datasets`.
+    - turbines: Turbine models for the power-curve engine, see `merge_datasets`.
+
+    Returns:
+    - The final dataset for the year, in memory (or lazily opened in chunked mode).
+    """
+    # Merge datasets for the given year
+    ds = merge_datasets(year, directories, static_layers, debug_outputs=debug_outputs, power_kernel=power_kernel,
+                        wind_statistic=wind_statistic, turbines=turbines)
+
+    # Dropping variables that are not needed for further analysis
+    # (the fused kernel does not create wind_80m and air_density, and the wind statistics are optional)
+    ds = ds.drop_vars(["air_density", 'wind_80m', 'sfcWind_cubic_mean', *wind_moment_variables.values()], errors='ignore')
+    # (the land use layer of land_use_pipeline.py has the class fractions instead of the ESA CCI flags)
+    ds = ds.drop_vars([
+        "change_count", 'current_pixel_state', 'observation_count', 'processed_flag', 'time', 'time_bnds',
+        'land_cover_fraction', 'ipcc_class'
+    ], errors='ignore')
+    ds = ds.drop_vars(['friction_coefficient', 'hurs', 'orog', 'ps', 'sfcWind', 'sftlf', 'tas'])
+    if debug_outputs:
+        essential_var_file_path = os.path.join(directories['merged'], f"essential_var_{year}.nc")
+        ds.to_netcdf(essential_var_file_path)
+        print(f"Essential variables saved for {year}")
+
+    # Apply land use masks: mark urban and water areas as missing
+    exclusion = static_layers['exclusion'].reindex_like(ds['power_generation'], method='nearest')
+    for name in ('power_generation', 'power_generation_by_turbine'):
+        if name in ds:
+            ds[name] = ds[name].where((exclusion & land_use_flags) == 0)
+    print(f"Masking applied for {year}")
+
+    # Replace NaN values and save the final file
+    for var in ds.data_vars:
+        if ds[var].dtype.kind in 'f':
+            ds[var] = ds[var].fillna(0)
+    final_file_path = os.path.join(directories['final_files'], f"final_file_{year}.nc")
+    chunks = static_layers.get('chunks')
+    if chunks is None:
+        ds = ds.load()
+        ds.to_netcdf(final_file_path)
+    else:
+        # Build the whole task graph first and compute it once while streaming to disk
+        ds.to_netcdf(final_file_path, compute=False).compute()
+        ds = xr.open_dataset(final_file_path, chunks=chunks)
+    print(f"All NaN Values removed and saved in 'final_files' directory for {year}")
+
+    return ds
+
+# Section 6: City-Level Data Analysis
+
+# Calculate theoretical maximum power output at rated wind speed
+P_rated = 0.5 * air_density * swept_area * power_coefficient * rated_wind_speed**3
+P_rated_kW = P_rated / 1000  # Convert to kilowatts (kW)
+max_annual_output = P_rated_kW * hours_per_year  # Maximal annual output in kWh
+
+def analyse_year(year, final_ds, engine=distance_engine, k=top_k, max_output=max_annual_output):
+    """
+    Rank the best wind farm locations for one year, per city and by power generation alone.
+
+    Parameters:
+    - year: The year being analysed.
+    - final_ds: The final dataset for the year from `process_year`.
+    - engine: City distance engine, 'vectorized' or 'loop'.
+    - k: Number of top locations kept per city and year.
+    - max_output: Maximal annual output of one turbine in kWh.
+
+    Returns:
+    - Tuple of (top_locations, top_locations_no_demand) DataFrames.
+    """
+    # Extracting wind power data
+    lon = final_ds['lon'].values
+    lat = final_ds['lat'].values
+    power_generation = final_ds['power_generation']
+    if power_generation.ndim == 3:
+        power_generation = power_generation[:,:,0]
+    power_generation = power_generation.values
+
+    # Load city energy demand data from CSV file
+    energy_demand_df = pd.read_csv(os.path.join(population_directory, f'city_power_demand_projection_{year}.csv'))
+
+    # Rank the best locations for each city
+    top_locations = city_top_locations(power_generation, lat, lon, energy_demand_df, year, max_output, engine=engine, cache_directory=distance_cache_directory, k=k)
+
+    # Rank the best locations by power generation alone
+    top_locations_no_demand = top_power_locations(power_generation, lat, lon, year, max_output, k=k)
+
+    print(f"The analysis for {year} has been completed.")
+    return top_locations, top_locations_no_demand
+
+# Section 7: Creating Output Files
+
+def create_kml(df, filename):
+    kml = simplekml.Kml()
+
+    for idx, row in df.iterrows():
+        pnt = kml.newpoint(name=f"{row['Year']} - Rank {row['Rank']}",
+                           coords=[(row['Lon'], row['Lat'])])
+        pnt.description = f"Year: {row['Year']}, Rank: {row['Rank']}"
+
+    kml.save(filename)
+
+def write_outputs(rcp, directories, all_years_top_locations, all_years_top_locations_no_demand):
+    """
+    Save the ranked locations of a scenario to Excel and KML files.
+
+    Parameters:
+    - rcp: The RCP scenario as a string, e.g. '4.5'.
+    - directories: Scenario directories from `scenario_directories`.
+    - all_years_top_locations: DataFrame with the top locations per city for all years.
+    - all_years_top_locations_no_demand: DataFrame with the top locations by power for all years.
+    """
+    # Save the results to an Excel file
+    all_years_top_locations.to_excel(os.path.join(directories['output'], f"RCP_{rcp}_top_locations.xlsx"), index=False)
+    print(f"All years processed successfully. Results saved to 'RCP_{rcp}_top_locations.xlsx'")
+
+    # Save the new DataFrame to a separate Excel file
+    all_years_top_locations_no_demand.to_excel(os.path.join(directories['output'], f"RCP_{rcp}_top_power_locations.xlsx"), index=False)
+    print(f"Results for top power generation locations saved to 'RCP_{rcp}_top_power_locations.xlsx'")
+
+    # Create and save KML for all_years_top_locations
+    create_kml(all_years_top_locations, os.path.join(directories['output'], "top_locations.kml"))
+
+    # Create and save KML for all_years_top_locations_no_demand
+    create_kml(all_years_top_locations_no_demand, os.path.join(directories['output'], "top_power_locations_no_demand.kml"))
+
+# Section 8: Sharing Static Layers Between Processes
+
+def share_static_layers(static_layers, directory):
+    """
+    Write the static layers to .npy files so worker processes can memory-map them.
+
+    Parameters:
+    - static_layers: Static layers from `load_static_layers`.
+    - directory: Directory for the .npy files; it must outlive the worker processes.
+
+    Returns:
+    - A small, picklable description of the layers for `attach_static_layers`.
+    """
+    if 'epochs' in static_layers:
+        # Every land use epoch is shared in its own subdirectory
+        epochs = {}
+        for epoch, layers in static_layers['epochs'].items():
+            epoch_directory = os.path.join(directory, f"epoch_{epoch}")
+            os.makedirs(epoch_directory, exist_ok=True)
+            epochs[epoch] = share_static_layers(layers, epoch_directory)
+        return {'epochs': epochs}
+
+    def describe(name, da):
+        file_path = os.path.join(directory, f"{name}.npy")
+        np.save(file_path, da.values)
+        return {'path': file_path, 'dims': da.dims, 'attrs': da.attrs, 'encoding': da.encoding}
+
+    static_ds = static_layers['dataset']
+    return {
+        'coords': {name: (coord.dims, coord.values, coord.attrs) for name, coord in static_ds.coords.items()},
+        'attrs': static_ds.attrs,
+        'dataset': {name: describe(name, static_ds[name]) for name in static_ds.data_vars},
+        'layers': {name: describe(name, static_layers[name]) for name in ('exclusion', 'available_fraction') if name in static_layers}
+    }
+
+def attach_static_layers(shared):
+    """
+    Rebuild the static layers from `share_static_layers` on top of read-only memmaps.
+
+    Parameters:
+    - shared: The description returned by `share_static_layers`.
+
+    Returns:
+    - Static layers in the same form as `load_static_layers`.
+    """
+    if 'epochs' in shared:
+        epochs = {epoch: attach_static_layers(description) for epoch, description in shared['epochs'].items()}
+        return dict(next(iter(epochs.values())), epochs=epochs)
+
+    coords = {name: xr.Variable(dims, values, attrs) for name, (dims, values, attrs) in shared['coords'].items()}
+
+    def attach(description):
+        variable = xr.Variable(description['dims'], np.load(description['path'], mmap_mode='r'), description['attrs'])
+        variable.encoding = description['encoding']
+        return variable
+
+    static_ds = xr.Dataset({name: attach(description) for name, description in shared['dataset'].items()},
+                           coords=coords, attrs=shared['attrs'])
+    static_layers = {'dataset': static_ds, 'chunks': None}
+    for name, description in shared['layers'].items():
+        layer_coords = {dim: coords[dim] for dim in description['dims'] if dim in coords}
+        static_layers[name] = xr.DataArray(attach(description), coords=layer_coords, name=name)
+    return static_layers
+
+_worker_static_layers = None
+
+def _init_worker(shared, chunks, land_use_epochs, coverage):
+    global _worker_static_layers
+    if chunks is None:
+        _worker_static_layers = attach_static_layers(shared)
+    else:
+        # Lazily opened layers are cheap to open again and hold no data in memory
+        _worker_static_layers = load_static_layers(chunks=chunks, land_use_epochs=land_use_epochs, coverage=coverage)
+
+def _run_year_job(rcp, year, engine, k, debug_outputs, power_kernel, wind_statistic, turbines):
+    return run_year(rcp, year, _worker_static_layers, engine=engine, k=k, debug_outputs=debug_outputs, power_kernel=power_kernel,
+                    wind_statistic=wind_statistic, turbines=turbines)
+
+
+# Section 9: Running Scenarios
+
+def run_year(rcp, year, static_layers, engine=distance_engine, k=top_k, debug_outputs=debug_outputs, power_kernel=power_kernel,
+             wind_statistic=wind_statistic, turbines=turbines):
+    """
+    Process and analyse a single scenario/year job.
+
+    Parameters:
+    - rcp: The RCP scenario as a string, e.g. '4.5'.
+    - year: The year to process.
+    - static_layers: Static layers from `load_static_layers` or `attach_static_layers`; with land use
+      epochs the year uses those of the nearest epoch.
+    - engine: City distance engine, 'vectorized' or 'loop'.
+    - k: Number of top locations kept per city and year.
+    - debug_outputs: Also save the intermediate Merged_{year}.nc and essential_var_{year}.nc files.
+    - power_kernel: Power generation kernel, see `merge_datasets`.
+    - wind_statistic: Wind speed statistic used for the power, see `merge_datasets`.
+    - turbines: Turbine models for the power-curve engine, see `merge_datasets`.
+
+    Returns:
+    - Tuple of (top_locations, top_locations_no_demand) DataFrames.
+    """
+    directories = scenario_directories(rcp)
+    static_layers = static_layers_for_year(static_layers, year)
+    final_ds = process_year(year, directories, static_layers, debug_outputs=debug_outputs, power_kernel=power_kernel,
+                            wind_statistic=wind_statistic, turbines=turbines)
+    # With a power curve the ranking uses the rated power of the first turbine model
+    max_output = rated_power(turbines[0]) * hours_per_year if turbines else max_annual_output
+    return analyse_year(year, final_ds, engine=engine, k=k, max_output=max_output)
+
+def finish_scenario(rcp, year_results):
+    """
+    Combine the per-year results of a scenario and write its Excel and KML outputs.
+
+    Parameters:
+    - rcp: The RCP scenario as a string, e.g. '4.5'.
+    - year_results: List of (top_locations, top_locations_no_demand) tuples in year order.
+
+    Returns:
+    - Tuple of (all_years_top_locations, all_years_top_locations_no_demand) DataFrames.
+    """
+    all_years_top_locations = ResultAccumulator()
+    all_years_top_locations_no_demand = ResultAccumulator()
+    for top_locations, top_locations_no_demand in year_results:
+        all_years_top_locations.append(top_locations)
+        all_years_top_locations_no_demand.append(top_locations_no_demand)
+
+    # Round all values in the DataFrame to one decimal place
+    all_years_top_locations, all_years_top_locations_no_demand = all_years_top_locations.to_frame().round(5), all_years_top_locations_no_demand.to_frame().round(5)
+
+    write_outputs(rcp, scenario_directories(rcp), all_years_top_locations, all_years_top_locations_no_demand)
+    return all_years_top_locations, all_years_top_locations_no_demand
+
+def run_scenario(rcp, years=years, static_layers=None, engine=distance_engine, k=top_k, debug_outputs=debug_outputs, chunks=chunks,
+                 power_kernel=power_kernel, wind_statistic=wind_statistic, turbines=turbines, land_use_epochs=land_use_epochs,
+                 coverage=protected_area_coverage):
+    """
+    Run the full model for one RCP scenario and write its Excel and KML outputs.
+
+    Parameters:
+    - rcp: The RCP scenario as a string, e.g. '4.5'.
+    - years: The years to analyse.
+    - static_layers: Static layers from `load_static_layers`; loaded here if not given.
+    - engine: City distance engine, 'vectorized' or 'loop'.
+    - k: Number of top locations kept per city and year.
+    - debug_outputs: Also save the intermediate Merged_{year}.nc and essential_var_{year}.nc files.
+    - chunks: Optional Dask chunks used when the static layers are loaded here.
+    - power_kernel: Power generation kernel, see `merge_datasets`.
+    - wind_statistic: Wind speed statistic used for the power, see `merge_datasets`.
+    - turbines: Turbine models for the power-curve engine, see `merge_datasets`.
+    - land_use_epochs: Land cover epochs used when the static layers are loaded here, see `load_static_layers`.
+    - coverage: Use the NSA/SPA coverage fractions when the static layers are loaded here, see `load_static_layers`.
+
+    Returns:
+    - Tuple of (all_years_top_locations, all_years_top_locations_no_demand) DataFrames.
+    """
+    if static_layers is None:
+        static_layers = load_static_layers(chunks=chunks, land_use_epochs=land_use_epochs, coverage=coverage)
+
+    # Process data for each year
+    year_results = [run_year(rcp, year, static_layers, engine=engine, k=k, debug_outputs=debug_outputs, power_kernel=power_kernel,
+                             wind_statistic=wind_statistic, turbines=turbines) for year in years]
+    return finish_scenario(rcp, year_results)
+
+def run_scenarios(rcps=scenarios, years=years, engine=distance_engine, k=top_k, workers=workers, debug_outputs=debug_outputs, chunks=chunks,
+                  power_kernel=power_kernel, wind_statistic=wind_statistic, turbines=turbines, land_use_epochs=land_use_epochs,
+                  coverage=protected_area_coverage):
+    """
+    Run several RCP scenarios in one process, loading the static layers only once.
+
+    With more than one worker the scenario/year jobs are fanned out over a process pool.
+    The static layers are written once to .npy files and memory-mapped by every worker,
+    and results are collected by (scenario, year) so the outputs do not depend on the
+    order in which jobs finish.
+
+    Parameters:
+    - rcps: The RCP scenarios to run.
+    - years: The years to analyse.
+    - engine: City distance engine, 'vectorized' or 'loop'.
+    - k: Number of top locations kept per city and year.
+    - workers: Number of worker processes; 1 runs every job in this process.
+    - debug_outputs: Also save the intermediate Merged_{year}.nc and essential_var_{year}.nc files.
+    - chunks: Optional Dask chunks, e.g. {'lat': 500, 'lon': 500}, for the chunked execution mode.
+    - power_kernel: Power generation kernel, see `merge_datasets`.
+    - wind_statistic: Wind speed statistic used for the power, see `merge_datasets`.
+    - turbines: Turbine models for the power-curve engine, see `merge_datasets`.
+    - land_use_epochs: Land cover epochs; each year uses the nearest one, see `load_static_layers`.
+    - coverage: Scale the power of cells partly in an NSA/SPA instead of zeroing it, see `load_static_layers`.
+
+    Returns:
+    - Dictionary of RCP scenario -> (all_years_top_locations, all_years_top_locations_no_demand).
+    """
+    static_layers = load_static_layers(chunks=chunks, land_use_epochs=land_use_epochs, coverage=coverage)
+    if workers <= 1:
+        return {rcp: run_scenario(rcp, years, static_layers=static_layers, engine=engine, k=k, debug_outputs=debug_outputs,
+                                  power_kernel=power_kernel, wind_statistic=wind_statistic, turbines=turbines) for rcp in rcps}
+
+    os.makedirs(cache_directory, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=cache_directory) as shared_directory:
+        shared = share_static_layers(static_layers, shared_directory) if chunks is None else None
+        # Spawn rather than fork so workers do not inherit open NetCDF/HDF5 handles
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_init_worker, initargs=(shared, chunks, land_use_epochs, coverage)) as executor:
+            futures = {(rcp, year): executor.submit(_run_year_job, rcp, year, engine, k, debug_outputs, power_kernel, wind_statistic, turbines)
+                       for rcp in rcps for year in years}
+            results = {job: future.result() for job, future in futures.items()}
+
+    return {rcp: finish_scenario(rcp, [results[(rcp, year)] for year in years]) for rcp in rcps}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the wind power siting model for one or more RCP scenarios.")
+    parser.add_argument('--rcp', nargs='+', default=scenarios, help="RCP scenarios to run, e.g. 2.6 4.5 8.5.")
+    parser.add_argument('--years', nargs='+', default=years, help="Years to analyse.")
+    parser.add_argument('--distance-engine', choices=['vectorized', 'loop'], default=distance_engine,
+                        help="City distance engine.")
+    parser.add_argument('--top-k', type=int, default=top_k, help="Number of top locations kept per city and year.")
+    parser.add_argument('--workers', type=int, default=workers, help="Number of worker processes for the scenario/year jobs.")
+    parser.add_argument('--debug-outputs', action='store_true', default=debug_outputs,
+                        help="Also save the intermediate Merged_{year}.nc and essential_var_{year}.nc files.")
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help="Run chunked with Dask, using lat/lon chunks of this many cells.")
+    parser.add_argument('--power-kernel', choices=['numpy', 'fused', 'fused-float32'], default=power_kernel,
+                        help="Power generation kernel: separate NumPy formulas or the fused, multi-threaded kernel.")
+    parser.add_argument('--wind-statistic', choices=['mean', 'cubed_mean', 'weibull'], default=wind_statistic,
+                        help="Wind speed cubed for the power: the annual mean sfcWind, or the cubic mean wind speed "
+                             "(measured or from the Weibull fit) from last_year_avg.py --moments.")
+    parser.add_argument('--turbine', nargs='+', choices=list(turbine_models), default=turbines,
+                        help="Use the power curves of these turbine models instead of the unbounded formula; the first one is ranked.")
+    parser.add_argument('--land-use-epochs', nargs='+', type=int, default=land_use_epochs,
+                        help="Land cover epochs from land_use_pipeline.py --epoch; each year uses the nearest one.")
+    parser.add_argument('--protected-area-coverage', action='store_true', default=protected_area_coverage,
+                        help="Scale the power of cells partly in an NSA/SPA by their uncovered share (Raster_Layer.py --coverage masks).")
+    args = parser.parse_args()
+
+    run_chunks = {'lat': args.chunk_size, 'lon': args.chunk_size} if args.chunk_size else chunks
+    run_scenarios(args.rcp, args.years, engine=args.distance_engine, k=args.top_k, workers=args.workers,
+                  debug_outputs=args.debug_outputs, chunks=run_chunks, power_kernel=args.power_kernel,
+                  wind_statistic=args.wind_statistic, turbines=args.turbine, land_use_epochs=args.land_use_epochs,
+                  coverage=args.protected_area_coverage)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import threading
+import numpy as np
+
+# Fused Power Generation Kernel
+# Computes power generation from sfcWind, friction_coefficient, ps, tas and hurs in one pass per
+# cell, instead of building full-grid temporaries for the log ratios, exp and cube in
+# calculate_wind_at_80m, calculate_air_density and calculate_power_generation.
+# Numba and numexpr are optional; without either the plain NumPy formulas are used.
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+if numba is not None:
+    def _power_generation_loop(sfcWind, friction_coefficient, ps, tas, hurs, out,
+                               log_target, log_reference, es_scale, es_a, es_b, rh_scale, Rd, Rv, Kelvin, power_scale):
+        # The inputs keep their own dtype and strides (zero strides where broadcast), and each
+        # value is cast to the computation dtype of out as it is read
+        cast = out.dtype.type
+        for i in numba.prange(out.shape[0]):
+            for j in range(out.shape[1]):
+                # Wind speed at 80m from the logarithmic wind profile
+                log_z0 = np.log(cast(friction_coefficient[i, j]))
+                wind_80m = cast(sfcWind[i, j]) * ((log_target - log_z0) / (log_reference - log_z0))
+
+                # Air density from surface pressure, temperature and relative humidity
+                tas_ij = cast(tas[i, j])
+                t = tas_ij - Kelvin
+                e = cast(hurs[i, j]) * rh_scale * es_scale * np.exp((es_a * t) / (t + es_b))
+                air_density = (cast(ps[i, j]) - e) / (Rd * tas_ij) + e / (Rv * tas_ij)
+
+                out[i, j] = power_scale * air_density * wind_80m * wind_80m * wind_80m
+
+    # Numba's default threading layer must only be driven from the main thread, so calls from
+    # worker threads (e.g. Dask chunks, which are already run in parallel) use the serial build.
+    _power_generation_parallel = numba.njit(parallel=True, cache=True)(_power_generation_loop)
+    _power_generation_serial = numba.njit(_power_generation_loop)  # Not cached: it shares the parallel build's cache entry
+
+def available_backends():
+    """
+    List the fused kernel backends that can run in this environment.
+
+    Returns:
+    - List of backend names, fastest first.
+    """
+    backends = []
+    if numba is not None:
+        backends.append('numba')
+    if numexpr is not None:
+        backends.append('numexpr')
+    backends.append('numpy')
+    return backends
+
+def fused_power_generation(sfcWind, friction_coefficient, ps, tas, hurs, reference_height, target_height,
+                           Rd, Rv, Kelvin, turbine_area, power_coefficient, dtype=None, backend='auto', threads=None):
+    """
+    Calculate power generation for a single wind turbine in one fused, multi-threaded pass.
+
+    Gives the same result as calculate_power_generation(calculate_wind_at_80m(...),
+    calculate_air_density(...), ...) without allocating the intermediate grids.
+
+    Parameters:
+    - sfcWind: Wind speed measured at the reference height (m/s).
+    - friction_coefficient: Surface friction coefficient.
+    - ps: Surface pressure in Pascals.
+    - tas: Air temperature in Kelvin.
+    - hurs: Relative humidity in percentage.
+    - reference_height: The height at which the reference wind speed is measured.
+    - target_height: The height for which the wind speed is to be estimated.
+    - Rd: Specific gas constant for dry air (J/kg·K).
+    - Rv: Specific gas constant for water vapor (J/kg·K).
+    - Kelvin: Conversion constant from Celsius to Kelvin.
+    - turbine_area: Area covered by the wind turbine in square meters.
+    - power_coefficient: Power coefficient of the turbine.
+    - dtype: Computation and output dtype, e.g. np.float32; defaults to the promoted input dtype.
+    - backend: 'numba', 'numexpr', 'numpy' or 'auto' for the fastest available one.
+    - threads: Number of threads for the numba and numexpr backends; None keeps their default.
+
+    Returns:
+    - Power generation in kilowatts, broadcast to the common shape of the inputs.
+    """
+    if backend == 'auto':
+        backend = available_backends()[0]
+    if backend not in available_backends():
+        raise ValueError(f"Fused kernel backend not available: {backend}")
+
+    inputs = [np.asarray(x) for x in (sfcWind, friction_coefficient, ps, tas, hurs)]
+    if dtype is None:
+        dtype = np.result_type(*inputs, np.float32)
+    dtype = np.dtype(dtype)
+    shape = np.broadcast_shapes(*(x.shape for x in inputs))
+
+    # Constants are cast to the computation dtype so the float32 mode stays in single precision
+    constants = {
+        'log_target': dtype.type(np.log(target_height)),
+        'log_reference': dtype.type(np.log(reference_height)),
+        'es_scale': dtype.type(6.1094 * 100),
+        'es_a': dtype.type(17.625),
+        'es_b': dtype.type(243.04),
+        'rh_scale': dtype.type(1 / 100.0),
+        'Rd': dtype.type(Rd),
+        'Rv': dtype.type(Rv),
+        'Kelvin': dtype.type(Kelvin),
+        'power_scale': dtype.type(0.5 * turbine_area * power_coefficient / 1000)
+    }
+
+    if backend == 'numba':
+        if threads is not None:
+            numba.set_num_threads(threads)
+        # Broadcasting and the 2D view of the grid do not copy the inputs, whatever their dtype
+        grid_shape = (int(np.prod(shape[:-1])), shape[-1]) if shape else (1, 1)
+        grids = [np.broadcast_to(x, shape).reshape(grid_shape) for x in inputs]
+        out = np.empty(grid_shape, dtype=dtype)
+        if threading.current_thread() is threading.main_thread():
+            _power_generation_parallel(*grids, out, *constants.values())
+        else:
+            _power_generation_serial(*grids, out, *constants.values())
+        return out.reshape(shape)
+
+    sfcWind, friction_coefficient, ps, tas, hurs = [x.astype(dtype, copy=False) for x in inputs]
+    if backend == 'numexpr':
+        if threads is not None:
+            numexpr.set_num_threads(threads)
+        return numexpr.evaluate(
+            "power_scale * ((ps - hurs * rh_scale * es_scale * exp((es_a * (tas - Kelvin)) / (tas - Kelvin + es_b))) / (Rd * tas)"
+            " + hurs * rh_scale * es_scale * exp((es_a * (tas - Kelvin)) / (tas - Kelvin + es_b)) / (Rv * tas))"
+            " * (sfcWind * (log_target - log(friction_coefficient)) / (log_reference - log(friction_coefficient))) ** 3",
+            local_dict=dict(constants, sfcWind=sfcWind, friction_coefficient=friction_coefficient, ps=ps, tas=tas, hurs=hurs)
+        ).astype(dtype, copy=False).reshape(shape)
+
+    c = constants
+    log_z0 = np.log(friction_coefficient)
+    wind_80m = sfcWind * ((c['log_target'] - log_z0) / (c['log_reference'] - log_z0))
+    t = tas - c['Kelvin']
+    e = hurs * c['rh_scale'] * c['es_scale'] * np.exp((c['es_a'] * t) / (t + c['es_b']))
+    air_density = (ps - e) / (c['Rd'] * tas) + e / (c['Rv'] * tas)
+    return np.broadcast_to(c['power_scale'] * air_density * wind_80m ** 3, shape).astype(dtype, copy=False)
@@ -1,14 +1,11 @@
 import xarray as xr
 import numpy as np
 import time
-from tqdm import tqdm 
 
 # Path to NetCDF files
 input_file = '/Users/jamesquessy/Desktop/Uni Work/Masters/Reasearch Project/Code/Power_Generation/land_use/land_use_uk_adjusted.nc'
 output_file = '/Users/jamesquessy/Desktop/Uni Work/Masters/Reasearch Project/Code/Power_Generation/land_use/land_use_adjusted.nc'
 
-ds = xr.open_dataset(input_file)
-
 # IPCC classification mapping
 ipcc_classes = {
     1: [10, 11, 12, 20, 30, 40],  # Agriculture
@@ -31,18 +28,130 @@ friction_coefficients = {
     7: 0.10   # Water -> Lakes, ocean, and smooth hard ground
 }
 
-# Adjust lccs_class values
-new_lccs_class = ds['lccs_class'].values.copy()
-for ipcc_class, lccs_values in ipcc_classes.items():
-    for lccs_value in lccs_values:
-        new_lccs_class[new_lccs_class == lccs_value] = ipcc_class
+row_chunk = 2048  # Rows of the land use grid reclassified at once.
+
+def build_reclassification_table(ipcc_classes=ipcc_classes, friction_coefficients=friction_coefficients):
+    """
+    Build the lookup table from raw LCCS class codes to IPCC classes and friction coefficients.
+
+    Parameters:
+    - ipcc_classes: Mapping of IPCC class -> list of LCCS codes.
+    - friction_coefficients: Mapping of IPCC class -> friction coefficient.
+
+    Returns:
+    - Structured array with one ('ipcc_class', 'friction_coefficient') entry per code 0-255.
+      Codes without an IPCC class keep their value and get a NaN friction coefficient.
+    """
+    table = np.zeros(256, dtype=[('ipcc_class', np.uint8), ('friction_coefficient', np.float64)])
+    table['ipcc_class'] = np.arange(256)
+    table['friction_coefficient'] = np.nan
+    for ipcc_class, lccs_values in ipcc_classes.items():
+        table['ipcc_class'][lccs_values] = ipcc_class
+        table['friction_coefficient'][lccs_values] = friction_coefficients[ipcc_class]
+    return table
+
+def reclassify(lccs_class, table):
+    """
+    Map raw LCCS class codes to IPCC classes and friction coefficients with one lookup table gather.
+
+    Parameters:
+    - lccs_class: Array of raw LCCS class codes, integer or float with NaN for missing cells.
+    - table: Lookup table from `build_reclassification_table`.
+
+    Returns:
+    - Tuple of (IPCC classes in the dtype of lccs_class, float64 friction coefficients).
+    """
+    values = np.asarray(lccs_class)
+    if values.dtype.kind == 'f':
+        missing = np.isnan(values)
+        codes = np.where(missing, 0, values).astype(np.intp)
+    else:
+        # Integer codes index the table directly, without a copy
+        missing = np.zeros(values.shape, dtype=bool)
+        codes = values
+    if codes.size and (codes.min() < 0 or codes.max() >= len(table)):
+        raise ValueError(f"LCCS class codes must be between 0 and {len(table) - 1}")
+
+    # Both outputs come from a single gather of the structured table
+    entries = np.take(table, codes)
+    new_lccs_class = entries['ipcc_class'].astype(values.dtype)
+    friction_coefficient = entries['friction_coefficient']
+    if missing.any():
+        new_lccs_class[missing] = np.nan
+        friction_coefficient[missing] = np.nan
+    return new_lccs_class, friction_coefficient
+
+def effective_friction_coefficient(fractions, classes=None, method='log', friction_coefficients=friction_coefficients):
+    """
+    Combine the friction coefficients (roughness lengths) of the land use classes covering a cell.
+
+    Parameters:
+    - fractions: Array of class fractions with the classes on the last axis.
+    - classes: IPCC classes of the last axis; all classes of friction_coefficients by default.
+    - method: 'log' for the logarithmic average exp(sum(f * ln(z0))), which keeps the log wind
+      profile of the mix, or 'area' for the area-weighted mean sum(f * z0).
+    - friction_coefficients: Mapping of IPCC class -> friction coefficient.
+
+    Returns:
+    - float64 friction coefficients, NaN where the fractions are missing or sum to 0.
+    """
+    classes = sorted(friction_coefficients) if classes is None else list(classes)
+    class_friction = np.array([friction_coefficients[int(ipcc_class)] for ipcc_class in classes], dtype=np.float64)
+    fractions = np.asarray(fractions, dtype=np.float64)
+    total = fractions.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'log':
+            friction_coefficient = np.exp(fractions @ np.log(class_friction) / total)
+        elif method == 'area':
+            friction_coefficient = fractions @ class_friction / total
+        else:
+            raise ValueError(f"Unknown roughness average '{method}', expected 'log' or 'area'")
+    return np.where(total > 0, friction_coefficient, np.nan)
+
+def reclassify_dataset(ds, table=None):
+    """
+    Replace 'lccs_class' with the IPCC classes and add 'friction_coefficient'.
+
+    Works on eager and Dask-chunked datasets; chunked datasets stay lazy and are reclassified chunk by chunk.
+
+    Parameters:
+    - ds: Land use dataset with the raw 'lccs_class'.
+    - table: Lookup table from `build_reclassification_table`; built from the module mappings if not given.
+
+    Returns:
+    - The reclassified dataset.
+    """
+    if table is None:
+        table = build_reclassification_table()
+    lccs_class = ds['lccs_class']
+    new_lccs_class, friction_coefficient = xr.apply_ufunc(
+        reclassify, lccs_class, kwargs={'table': table}, output_core_dims=[[], []],
+        dask='parallelized', output_dtypes=[lccs_class.dtype, np.float64], keep_attrs=True
+    )
+    new_lccs_class.encoding = lccs_class.encoding
+    friction_coefficient.attrs = {}
+    ds = ds.copy()
+    ds['lccs_class'] = new_lccs_class
+    ds['friction_coefficient'] = friction_coefficient
+    return ds
 
-ds['lccs_class'].values = new_lccs_class
+def reclassify_file(input_file, output_file, chunk_rows=row_chunk):
+    """
+    Reclassify a land use file chunk by chunk, so inputs of any size fit in memory.
 
-# Calculate friction coefficients
-friction_coeff_array = np.vectorize(friction_coefficients.get)(new_lccs_class)
+    Parameters:
+    - input_file: Land use NetCDF file with the raw 'lccs_class'.
+    - output_file: Output NetCDF file.
+    - chunk_rows: Rows (latitudes) reclassified at once.
+    """
+    with xr.open_dataset(input_file) as source:
+        row_dim = 'lat' if 'lat' in source['lccs_class'].dims else source['lccs_class'].dims[0]
+    with xr.open_dataset(input_file, chunks={row_dim: chunk_rows}) as ds:
+        # Build the whole task graph first and compute it once while streaming to disk
+        reclassify_dataset(ds).to_netcdf(output_file, compute=False).compute()
 
-# Add new variable to dataset
-ds['friction_coefficient'] = xr.DataArray(friction_coeff_array, dims=ds['lccs_class'].dims)
-ds.to_netcdf(output_file)
-ds.close()
+if __name__ == '__main__':
+    start = time.time()
+    reclassify_file(input_file, output_file)
+    end = time.time()
+    print(f'elapsed time is {end - start} seconds')
@@ -0,0 +1,623 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+import scipy.sparse
+import xarray as xr
+from land_use_change import build_reclassification_table, effective_friction_coefficient, ipcc_classes, reclassify
+from land_use_slice import bbox_indexers
+from point_grid import cell_index
+
+# Land Use Pipeline
+# Turns the global ESA CCI land cover file into the model-grid land use layer in one streaming
+# pass: each block of rows is sliced to the model grid, reclassified to IPCC classes and
+# aggregated into the area of each class in each model cell. Only the per-block areas are kept,
+# so no intermediate NetCDF files are written, and they are checkpointed so an interrupted run
+# resumes at the next block.
+#
+# The aggregation is a sparse matrix from the fine pixels to the model cells holding the pixel
+# areas. It only depends on the two grids, so it is cached and every further land cover year
+# costs one sparse matrix product per block. For a stack of land cover epochs only the pixels
+# that changed since the previous epoch are reclassified and moved between classes.
+#
+# The friction coefficient of a cell is the logarithmic or area-weighted average of its classes,
+# and final.py excludes urban/water cells by their fraction of the cell
+# (exclusion_mask.excluded_fraction). final.py --land-use-epochs runs each year with the nearest epoch.
+
+# Path to the global land cover file and the model grid
+global_land_use_file = '/Users/jamesquessy/Desktop/Uni Work/Masters/Reasearch Project/Code/Power_Generation/land_use/land_use.nc'
+model_grid_file = '/Users/jamesquessy/Developer/Projects/Masters/Data/Raster_Data/Orogrophy/orography_remap.nc'
+output_file = '/Users/jamesquessy/Developer/Projects/Masters/Data/Raster_Data/land_use/remaped_land.nc'
+
+epoch_file_pattern = 'remaped_land_{epoch}.nc'  # Output file of each land cover epoch written by run_epochs.
+row_chunk = 1024  # Rows (latitudes) of the global file processed at once.
+roughness_average = 'log'  # Friction coefficient of mixed cells: 'log' (logarithmic) or 'area' (area-weighted) average.
+pipeline_version = 2  # Bump when the way blocks are aggregated changes, to invalidate checkpoints.
+
+def grid_bounds(grid_ds):
+    """
+    Return the (min_lon, min_lat, max_lon, max_lat) bounding box covered by the model grid cells.
+
+    Parameters:
+    - grid_ds: Dataset with the model grid 'lat' and 'lon' coordinates.
+    """
+    bounds = []
+    for name in ('lon', 'lat'):
+        centres = np.sort(grid_ds[name].values)
+        step = (centres[-1] - centres[0]) / (len(centres) - 1) if len(centres) > 1 else 0
+        bounds.append((centres[0] - step / 2, centres[-1] + step / 2))
+    return bounds[0][0], bounds[1][0], bounds[0][1], bounds[1][1]
+
+def checkpoint_key(file_path, grid_ds, chunk_rows, classes, previous_key=None):
+    """
+    Build the key of the checkpoints of one run from its source file, model grid and settings.
+
+    Parameters:
+    - file_path: Global land cover NetCDF file.
+    - grid_ds: Dataset with the model grid 'lat' and 'lon' coordinates.
+    - chunk_rows: Rows processed per block.
+    - classes: IPCC classes aggregated.
+    - previous_key: Key of the previous epoch the run is an update of, if any.
+
+    Returns:
+    - Short hexadecimal key.
+    """
+    stat = os.stat(file_path)
+    digest = hashlib.sha256(json.dumps([pipeline_version, os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size,
+                                        chunk_rows, classes, ipcc_classes, previous_key]).encode())
+    for name in ('lat', 'lon'):
+        digest.update(np.ascontiguousarray(grid_ds[name].values, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+def aggregation_key(fine_lat, fine_lon, grid_ds, chunk_rows):
+    """
+    Build the key of the cached aggregation matrices from the fine and model grids.
+
+    Parameters:
+    - fine_lat: Latitudes of the sliced land cover.
+    - fine_lon: Longitudes of the sliced land cover.
+    - grid_ds: Dataset with the model grid 'lat' and 'lon' coordinates.
+    - chunk_rows: Rows per block.
+
+    Returns:
+    - Short hexadecimal key.
+    """
+    digest = hashlib.sha256(json.dumps([pipeline_version, chunk_rows]).encode())
+    for values in (fine_lat, fine_lon, grid_ds['lat'].values, grid_ds['lon'].values):
+        digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:16]
+
+def aggregation_matrix(fine_lat, lat_cells, lon_cells, grid_shape):
+    """
+    Build the sparse matrix summing the pixel areas of one block of rows into the model grid cells.
+
+    Each pixel (column) has a single entry, its area, in the row of the model cell containing it,
+    so the matrix is built directly in compressed sparse column form without sorting.
+
+    Parameters:
+    - fine_lat: Latitudes of the block rows.
+    - lat_cells: Model grid row of each block row, -1 outside the grid.
+    - lon_cells: Model grid column of each block column, -1 outside the grid.
+    - grid_shape: (lat, lon) shape of the model grid.
+
+    Returns:
+    - Tuple of (first model grid row, CSC matrix of shape (rows * lon, block pixels)), or None
+      if the block lies outside the grid.
+    """
+    inside = (lat_cells[:, np.newaxis] >= 0) & (lon_cells[np.newaxis, :] >= 0)
+    if not inside.any():
+        return None
+
+    # Only the model rows the block falls into get a matrix row
+    rows = lat_cells[lat_cells >= 0]
+    first_row, n_rows = int(rows.min()), int(rows.max() - rows.min() + 1)
+    n_lon = grid_shape[1]
+    cells = (lat_cells[:, np.newaxis] - first_row) * n_lon + lon_cells[np.newaxis, :]
+
+    # Pixels of an equal-angle grid shrink with the cosine of their latitude
+    area = np.broadcast_to(np.cos(np.deg2rad(fine_lat))[:, np.newaxis], inside.shape)
+    data = np.where(inside, area, 0).astype(np.float32).ravel()
+    indices = np.where(inside, cells, 0).astype(np.int32).ravel()
+    indptr = np.arange(data.size + 1, dtype=np.int32)
+    return first_row, scipy.sparse.csc_matrix((data, indices, indptr), shape=(n_rows * n_lon, data.size))
+
+def save_aggregation_matrix(map_file, aggregation):
+    """
+    Atomically save the aggregation matrix of one block, or an empty marker if it has none.
+
+    Parameters:
+    - map_file: Output .npz file.
+    - aggregation: Result of `aggregation_matrix`.
+    """
+    temp_file = f"{map_file}.{os.getpid()}.tmp.npz"
+    if aggregation is None:
+        np.savez(temp_file, first_row=-1)
+    else:
+        first_row, matrix = aggregation
+        np.savez(temp_file, first_row=first_row, shape=matrix.shape, data=matrix.data, indices=matrix.indices)
+    os.replace(temp_file, map_file)
+
+def load_aggregation_matrix(map_file):
+    """
+    Load an aggregation matrix saved by `save_aggregation_matrix`.
+
+    Parameters:
+    - map_file: The .npz file.
+
+    Returns:
+    - Tuple of (first model grid row, CSC matrix), or None for a block outside the grid.
+    """
+    with np.load(map_file) as saved:
+        if int(saved['first_row']) < 0:
+            return None
+        indptr = np.arange(saved['data'].size + 1, dtype=saved['indices'].dtype)
+        matrix = scipy.sparse.csc_matrix((saved['data'], saved['indices'], indptr), shape=tuple(saved['shape']))
+        return int(saved['first_row']), matrix
+
+def class_indicator(lccs_class, table, class_slots):
+    """
+    Build the sparse one-hot IPCC class indicator of a set of pixels.
+
+    Parameters:
+    - lccs_class: 1D array of raw LCCS class codes.
+    - table: Lookup table from `build_reclassification_table`.
+    - class_slots: Array mapping an IPCC class to its position in the areas, -1 for unmapped codes.
+
+    Returns:
+    - CSR matrix of shape (pixels, classes) with a 1 in the column of each classified pixel's class;
+      pixels with unmapped or missing codes have an empty row.
+    """
+    ipcc_class, friction_coefficient = reclassify(lccs_class, table)
+    classified = ~np.isnan(friction_coefficient)
+    slots = class_slots[ipcc_class[classified].astype(np.intp)]
+    indptr = np.concatenate([[0], np.cumsum(classified)]).astype(np.int64)
+    return scipy.sparse.csr_matrix((np.ones(slots.size, dtype=np.float32), slots, indptr),
+                                   shape=(classified.size, class_slots.max() + 1))
+
+def aggregate_block(lccs_class, aggregation, table, class_slots, grid_shape):
+    """
+    Sum the area of each IPCC class in each model grid cell for one block of rows.
+
+    Parameters:
+    - lccs_class: 2D (lat, lon) block of raw LCCS class codes.
+    - aggregation: Aggregation matrix of the block from `aggregation_matrix`.
+    - table: Lookup table from `build_reclassification_table`.
+    - class_slots: Array mapping an IPCC class to its position in the areas, -1 for unmapped codes.
+    - grid_shape: (lat, lon) shape of the model grid.
+
+    Returns:
+    - Tuple of (first model grid row, float64 areas of shape (rows, lon, classes)), or None if the
+      block lies outside the grid.
+    """
+    if aggregation is None:
+        return None
+    first_row, matrix = aggregation
+    class_area = (matrix @ class_indicator(np.ravel(lccs_class), table, class_slots)).toarray()
+    return first_row, class_area.astype(np.float64).reshape(-1, grid_shape[1], class_area.shape[1])
+
+def diff_block(previous_lccs_class, lccs_class):
+    """
+    Build the diff index of one block of rows between two land cover epochs.
+
+    Parameters:
+    - previous_lccs_class: Block of raw LCCS class codes of the previous epoch.
+    - lccs_class: The same block in the new epoch.
+
+    Returns:
+    - Tuple of (flat positions of the changed pixels, their previous codes, their new codes).
+    """
+    previous_lccs_class, lccs_class = np.ravel(previous_lccs_class), np.ravel(lccs_class)
+    changed = previous_lccs_class != lccs_class
+    if lccs_class.dtype.kind == 'f' or previous_lccs_class.dtype.kind == 'f':
+        # Pixels missing in both epochs did not change
+        changed &= ~(np.isnan(previous_lccs_class) & np.isnan(lccs_class))
+    positions = np.flatnonzero(changed)
+    return positions, previous_lccs_class[positions], lccs_class[positions]
+
+def update_block(block_area, aggregation, diff, table, class_slots):
+    """
+    Update the class areas of one block of rows with the pixels that changed between two epochs.
+
+    Only the changed pixels are reclassified: their columns of the aggregation matrix move their
+    area from the previous class to the new one.
+
+    Parameters:
+    - block_area: Class areas of the block in the previous epoch, from `aggregate_block`.
+    - aggregation: Aggregation matrix of the block from `aggregation_matrix`.
+    - diff: Diff index of the block from `diff_block`.
+    - table: Lookup table from `build_reclassification_table`.
+    - class_slots: Array mapping an IPCC class to its position in the areas, -1 for unmapped codes.
+
+    Returns:
+    - The class areas of the block in the new epoch, in the form of `aggregate_block`.
+    """
+    positions, previous_codes, codes = diff
+    if block_area is None or positions.size == 0:
+        return block_area
+    first_row, matrix = aggregation
+    change = class_indicator(codes, table, class_slots) - class_indicator(previous_codes, table, class_slots)
+    area_change = (matrix[:, positions] @ change).toarray().reshape(block_area[1].shape)
+    # Rounding must not leave a class with a tiny negative area
+    return first_row, np.maximum(block_area[1] + area_change, 0)
+
+def save_checkpoint(checkpoint_directory, row_start, block_area):
+    """
+    Atomically save the class areas of one block, or an empty marker if it has none.
+
+    Parameters:
+    - checkpoint_directory: Directory of the run's checkpoints.
+    - row_start: First row of the block in the global file.
+    - block_area: Result of `aggregate_block`.
+    """
+    checkpoint_file = os.path.join(checkpoint_directory, f"rows_{row_start:07d}.npz")
+    temp_file = f"{checkpoint_file}.{os.getpid()}.tmp.npz"
+    if block_area is None:
+        np.savez(temp_file, first_row=-1, class_area=np.zeros((0, 0, 0), dtype=np.float32))
+    else:
+        np.savez_compressed(temp_file, first_row=block_area[0], class_area=block_area[1])
+    os.replace(temp_file, checkpoint_file)
+
+def land_use_layer(class_area, grid_ds, classes, roughness_average=roughness_average):
+    """
+    Build the model-grid land use dataset from the area of each class in each cell.
+
+    Parameters:
+    - class_area: Array of shape (lat, lon, classes) with the area of each class in each cell.
+    - grid_ds: Dataset with the model grid 'lat' and 'lon' coordinates.
+    - classes: IPCC classes of the last axis of class_area.
+    - roughness_average: 'log' or 'area' average of the class friction coefficients, see
+      `land_use_change.effective_friction_coefficient`.
+
+    Returns:
+    - Dataset with the dominant class 'lccs_class', the 'friction_coefficient' averaged over the
+      classes and the 'land_cover_fraction' of every class, NaN in cells without land cover data.
+    """
+    total = class_area.sum(axis=-1)
+    covered = total > 0
+    fractions = np.where(covered[..., np.newaxis], class_area / np.where(covered, total, 1)[..., np.newaxis], np.nan)
+    dominant = np.asarray(classes, dtype=np.float64)[class_area.argmax(axis=-1)]
+    friction_coefficient = effective_friction_coefficient(fractions, classes, method=roughness_average)
+
+    coords = {'lat': grid_ds['lat'].values, 'lon': grid_ds['lon'].values}
+    return xr.Dataset(
+        {
+            'lccs_class': (('lat', 'lon'), np.where(covered, dominant, np.nan).astype(np.float32),
+                           {'long_name': 'Dominant IPCC land use class'}),
+            'friction_coefficient': (('lat', 'lon'), friction_coefficient,
+                                     {'long_name': 'Surface friction coefficient', 'roughness_average': roughness_average}),
+            'land_cover_fraction': (('ipcc_class', 'lat', 'lon'), np.moveaxis(fractions, -1, 0).astype(np.float32),
+                                    {'long_name': 'Area fraction of the cell covered by each IPCC land use class'})
+        },
+        coords={'ipcc_class': list(classes), **coords}
+    )
+
+def sliced_land_cover(ds, grid_ds):
+    """
+    Slice the land cover of a global file to the model grid and find the model cell of each row and column.
+
+    Parameters:
+    - ds: Global land cover dataset with the raw 'lccs_class'.
+    - grid_ds: Dataset with the model grid 'lat' and 'lon' coordinates.
+
+    Returns:
+    - Tuple of (lazily indexed 2D (lat, lon) 'lccs_class', its first row in the global file,
+      model grid row of each row, model grid column of each column).
+    """
+    indexers = bbox_indexers(ds, grid_bounds(grid_ds))
+    lccs_class = ds['lccs_class'].isel(indexers)
+    if 'time' in lccs_class.dims:
+        lccs_class = lccs_class.isel(time=0)
+    lccs_class = lccs_class.transpose('lat', 'lon')
+    lat_cells = cell_index(lccs_class['lat'].values, grid_ds['lat'].values)
+    lon_cells = cell_index(lccs_class['lon'].values, grid_ds['lon'].values)
+    return lccs_class, indexers['lat'].start, lat_cells, lon_cells
+
+def prepare_checkpoints(checkpoint_directory, key):
+    """
+    Create the checkpoint directory of a run, removing checkpoints left by a run with a different key.
+
+    Parameters:
+    - checkpoint_directory: Directory of the run's checkpoints.
+    - key: Key from `checkpoint_key`.
+    """
+    key_file = os.path.join(checkpoint_directory, 'key.json')
+    if os.path.exists(key_file):
+        with open(key_file) as f:
+            if json.load(f) != key:
+                shutil.rmtree(checkpoint_directory)
+    os.makedirs(checkpoint_directory, exist_ok=True)
+    with open(key_file, 'w') as f:
+        json.dump(key, f)
+
+def block_aggregation(grid_map_directory, row_start, fine_lat, lat_cells, lon_cells, grid_shape):
+    """
+    Load the aggregation matrix of one block of rows from the cache, building and caching it if needed.
+
+    Parameters:
+    - grid_map_directory: Cache directory of the aggregation matrices of the two grids.
+    - row_start: First row of the block in the sliced land cover.
+    - fine_lat: Latitudes of the block rows.
+    - lat_cells: Model grid row of each block row, -1 outside the grid.
+    - lon_cells: Model grid column of each block column, -1 outside the grid.
+    - grid_shape: (lat, lon) shape of the model grid.
+
+    Returns:
+    - The aggregation matrix, see `aggregation_matrix`.
+    """
+    map_file = os.path.join(grid_map_directory, f"rows_{row_start:07d}.npz")
+    if os.path.exists(map_file):
+        return load_aggregation_matrix(map_file)
+    aggregation = aggregation_matrix(fine_lat, lat_cells, lon_cells, grid_shape)
+    save_aggregation_matrix(map_file, aggregation)
+    return aggregation
+
+def load_checkpoint(checkpoint_file):
+    """
+    Load the class areas of one block saved by `save_checkpoint`.
+
+    Parameters:
+    - checkpoint_file: The .npz checkpoint file.
+
+    Returns:
+    - The class areas in the form of `aggregate_block`.
+    """
+    with np.load(checkpoint_file) as block:
+        first_row = int(block['first_row'])
+        return (first_row, block['class_area']) if first_row >= 0 else None
+
+def assemble_class_area(checkpoint_directory, grid_shape, n_classes):
+    """
+    Add up the class areas of all blocks of a run.
+
+    Parameters:
+    - checkpoint_directory: Directory of the run's checkpoints.
+    - grid_shape: (lat, lon) shape of the model grid.
+    - n_classes: Number of IPCC classes.
+
+    Returns:
+    - float64 array of shape (lat, lon, classes).
+    """
+    class_area = np.zeros((*grid_shape, n_classes), dtype=np.float64)
+    for name in sorted(os.listdir(checkpoint_directory)):
+        if name.startswith('rows_') and name.endswith('.npz'):
+            block_area = load_checkpoint(os.path.join(checkpoint_directory, name))
+            if block_area is not None:
+                first_row, area = block_area
+                class_area[first_row:first_row + area.shape[0]] += area
+    return class_area
+
+def write_land_use(land_use_ds, output_path):
+    """
+    Atomically write a model-grid land use dataset.
+
+    Parameters:
+    - land_use_ds: Dataset from `land_use_layer`.
+    - output_path: Output NetCDF file.
+    """
+    temp_file_path = f"{output_path}.{os.getpid()}.tmp"
+    land_use_ds.to_netcdf(temp_file_path, encoding={'land_cover_fraction': {'zlib': True, 'complevel': 4}})
+    os.replace(temp_file_path, output_path)
+    print(f"Land use on the model grid saved to {output_path}")
+
+def pipeline_setup(grid_file_path):
+    """
+    Load the model grid and build the reclassification tables shared by the pipeline runs.
+
+    Parameters:
+    - grid_file_path: NetCDF file on the model grid.
+
+    Returns:
+    - Tuple of (model grid dataset, grid shape, IPCC classes, lookup table, class slots).
+    """
+    classes = sorted(ipcc_classes)
+    table = build_reclassification_table()
+    class_slots = np.full(len(table), -1, dtype=np.intp)
+    class_slots[classes] = np.arange(len(classes))
+    with xr.open_dataset(grid_file_path) as grid_ds:
+        grid_ds = grid_ds[['lat', 'lon']].load()
+    return grid_ds, (grid_ds.sizes['lat'], grid_ds.sizes['lon']), classes, table, class_slots
+
+def run_pipeline(file_path=global_land_use_file, grid_file_path=model_grid_file, output_path=output_file,
+                 chunk_rows=row_chunk, checkpoint_directory=None, keep_checkpoints=False, map_directory=None,
+                 roughness_average=roughness_average):
+    """
+    Slice, reclassify and regrid the global land cover to the model grid in one streaming pass.
+
+    Each block of rows is read once, reclassified with the lookup table of land_use_change.py and
+    aggregated into the area of each IPCC class in each model cell with the block's cached
+    aggregation matrix. The areas of every finished block are checkpointed, so rerunning after an
+    interruption skips the blocks already done.
+
+    Parameters:
+    - file_path: Global ESA CCI land cover NetCDF file with the raw 'lccs_class'.
+    - grid_file_path: NetCDF file on the model grid, e.g. the remapped orography.
+    - output_path: Output land use NetCDF file on the model grid.
+    - chunk_rows: Rows (latitudes) of the global file processed at once.
+    - checkpoint_directory: Directory for the block checkpoints; defaults to '{output_path}.chunks'.
+    - keep_checkpoints: Keep the checkpoints after the output is written.
+    - map_directory: Directory caching the aggregation matrices; defaults to 'aggregation_maps'
+      next to the output. Land cover files of other years on the same grids reuse them.
+    - roughness_average: 'log' or 'area' average of the class friction coefficients.
+
+    Returns:
+    - The land use dataset written to output_path (see `land_use_layer`).
+    """
+    checkpoint_directory = checkpoint_directory or f"{output_path}.chunks"
+    map_directory = map_directory or os.path.join(os.path.dirname(os.path.abspath(output_path)), 'aggregation_maps')
+    grid_ds, grid_shape, classes, table, class_slots = pipeline_setup(grid_file_path)
+
+    # Checkpoints of a different source, grid or block size are stale
+    prepare_checkpoints(checkpoint_directory, checkpoint_key(file_path, grid_ds, chunk_rows, classes))
+
+    with xr.open_dataset(file_path) as ds:
+        lccs_class, first_row, lat_cells, lon_cells = sliced_land_cover(ds, grid_ds)
+        fine_lat = lccs_class['lat'].values
+        grid_map_directory = os.path.join(map_directory, aggregation_key(fine_lat, lccs_class['lon'].values, grid_ds, chunk_rows))
+        os.makedirs(grid_map_directory, exist_ok=True)
+
+        n_rows = lccs_class.sizes['lat']
+        for row_start in range(0, n_rows, chunk_rows):
+            checkpoint_row = first_row + row_start
+            if os.path.exists(os.path.join(checkpoint_directory, f"rows_{checkpoint_row:07d}.npz")):
+                continue
+            rows = slice(row_start, min(row_start + chunk_rows, n_rows))
+
+            # The aggregation matrix only depends on the grids, so it is built once for all land cover years
+            aggregation = block_aggregation(grid_map_directory, row_start, fine_lat[rows], lat_cells[rows], lon_cells, grid_shape)
+            block_area = aggregate_block(lccs_class[rows].values, aggregation, table, class_slots, grid_shape)
+            save_checkpoint(checkpoint_directory, checkpoint_row, block_area)
+            print(f"Rows {rows.start}-{rows.stop} of {n_rows} done")
+
+    # Add up the block areas; blocks of a previous interrupted run are read back the same way
+    land_use_ds = land_use_layer(assemble_class_area(checkpoint_directory, grid_shape, len(classes)), grid_ds, classes,
+                                 roughness_average=roughness_average)
+    write_land_use(land_use_ds, output_path)
+    if not keep_checkpoints:
+        shutil.rmtree(checkpoint_directory)
+    return land_use_ds
+
+def update_pipeline(previous_file_path, file_path, previous_checkpoint_directory, checkpoint_directory, diff_directory,
+                    grid_file_path=model_grid_file, output_path=output_file, chunk_rows=row_chunk, map_directory=None,
+                    roughness_average=roughness_average):
+    """
+    Build the model-grid land use of a new land cover epoch from the previous one and their differences.
+
+    For each block of rows the diff index of the changed pixels is computed once and cached, and
+    only those pixels are reclassified and moved between classes in the previous epoch's areas.
+    Blocks without changes are carried over. Like `run_pipeline`, finished blocks are checkpointed.
+
+    Parameters:
+    - previous_file_path: Global land cover file of the previous epoch.
+    - file_path: Global land cover file of the new epoch, on the same grid.
+    - previous_checkpoint_directory: Block checkpoints of the previous epoch, kept by its run.
+    - checkpoint_directory: Directory for the block checkpoints of the new epoch.
+    - diff_directory: Directory caching the diff index of each block between the two epochs.
+    - grid_file_path: NetCDF file on the model grid.
+    - output_path: Output land use NetCDF file of the new epoch.
+    - chunk_rows: Rows (latitudes) processed at once; must match the previous epoch's run.
+    - map_directory: Directory caching the aggregation matrices, see `run_pipeline`.
+    - roughness_average: 'log' or 'area' average of the class friction coefficients.
+
+    Returns:
+    - The land use dataset written to output_path (see `land_use_layer`).
+    """
+    map_directory = map_directory or os.path.join(os.path.dirname(os.path.abspath(output_path)), 'aggregation_maps')
+    grid_ds, grid_shape, classes, table, class_slots = pipeline_setup(grid_file_path)
+
+    with open(os.path.join(previous_checkpoint_directory, 'key.json')) as f:
+        previous_key = json.load(f)
+    prepare_checkpoints(checkpoint_directory, checkpoint_key(file_path, grid_ds, chunk_rows, classes, previous_key=previous_key))
+    os.makedirs(diff_directory, exist_ok=True)
+
+    changed_pixels = 0
+    with xr.open_dataset(previous_file_path) as previous_ds, xr.open_dataset(file_path) as ds:
+        previous_lccs_class = sliced_land_cover(previous_ds, grid_ds)[0]
+        lccs_class, first_row, lat_cells, lon_cells = sliced_land_cover(ds, grid_ds)
+        if not (np.array_equal(previous_lccs_class['lat'].values, lccs_class['lat'].values)
+                and np.array_equal(previous_lccs_class['lon'].values, lccs_class['lon'].values)):
+            raise ValueError(f"{previous_file_path} and {file_path} must be on the same grid")
+        fine_lat = lccs_class['lat'].values
+        grid_map_directory = os.path.join(map_directory, aggregation_key(fine_lat, lccs_class['lon'].values, grid_ds, chunk_rows))
+        os.makedirs(grid_map_directory, exist_ok=True)
+
+        n_rows = lccs_class.sizes['lat']
+        for row_start in range(0, n_rows, chunk_rows):
+            checkpoint_row = first_row + row_start
+            checkpoint_name = f"rows_{checkpoint_row:07d}.npz"
+            if os.path.exists(os.path.join(checkpoint_directory, checkpoint_name)):
+                continue
+            rows = slice(row_start, min(row_start + chunk_rows, n_rows))
+
+            diff_file = os.path.join(diff_directory, checkpoint_name)
+            if os.path.exists(diff_file):
+                with np.load(diff_file) as saved:
+                    diff = (saved['positions'], saved['previous_codes'], saved['codes'])
+            else:
+                diff = diff_block(previous_lccs_class[rows].values, lccs_class[rows].values)
+                temp_file = f"{diff_file}.{os.getpid()}.tmp.npz"
+                np.savez_compressed(temp_file, positions=diff[0], previous_codes=diff[1], codes=diff[2])
+                os.replace(temp_file, diff_file)
+            changed_pixels += diff[0].size
+
+            block_area = load_checkpoint(os.path.join(previous_checkpoint_directory, checkpoint_name))
+            if diff[0].size:
+                aggregation = block_aggregation(grid_map_directory, row_start, fine_lat[rows], lat_cells[rows], lon_cells, grid_shape)
+                block_area = update_block(block_area, aggregation, diff, table, class_slots)
+            save_checkpoint(checkpoint_directory, checkpoint_row, block_area)
+    print(f"{changed_pixels} changed pixels reprocessed since {previous_file_path}")
+
+    land_use_ds = land_use_layer(assemble_class_area(checkpoint_directory, grid_shape, len(classes)), grid_ds, classes,
+                                 roughness_average=roughness_average)
+    write_land_use(land_use_ds, output_path)
+    return land_use_ds
+
+def run_epochs(epoch_files, grid_file_path=model_grid_file, output_directory=os.path.dirname(output_file),
+               chunk_rows=row_chunk, map_directory=None, roughness_average=roughness_average):
+    """
+    Build the model-grid land use of a stack of land cover epochs, each one incrementally from the previous.
+
+    The first epoch runs the full pipeline; every later epoch only reprocesses the pixels that
+    changed (see `update_pipeline`). The block areas of every epoch are kept in
+    'land_use_blocks' and the diff indices in 'land_use_diffs' under output_directory, so adding
+    an epoch or rerunning after an interruption only does the missing work.
+
+    Parameters:
+    - epoch_files: Dictionary of epoch (year) -> global land cover file.
+    - grid_file_path: NetCDF file on the model grid.
+    - output_directory: Directory of the epoch outputs, named after `epoch_file_pattern`.
+    - chunk_rows: Rows (latitudes) processed at once.
+    - map_directory: Directory caching the aggregation matrices, see `run_pipeline`.
+    - roughness_average: 'log' or 'area' average of the class friction coefficients.
+
+    Returns:
+    - Dictionary of epoch -> output land use file.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    map_directory = map_directory or os.path.join(output_directory, 'aggregation_maps')
+    epochs = sorted(epoch_files)
+    outputs = {epoch: os.path.join(output_directory, epoch_file_pattern.format(epoch=epoch)) for epoch in epochs}
+    blocks = {epoch: os.path.join(output_directory, 'land_use_blocks', str(epoch)) for epoch in epochs}
+
+    run_pipeline(epoch_files[epochs[0]], grid_file_path, outputs[epochs[0]], chunk_rows=chunk_rows,
+                 checkpoint_directory=blocks[epochs[0]], keep_checkpoints=True, map_directory=map_directory,
+                 roughness_average=roughness_average)
+    for previous, epoch in zip(epochs, epochs[1:]):
+        diff_directory = os.path.join(output_directory, 'land_use_diffs', f"{previous}_{epoch}")
+        update_pipeline(epoch_files[previous], epoch_files[epoch], blocks[previous], blocks[epoch], diff_directory,
+                        grid_file_path, outputs[epoch], chunk_rows=chunk_rows, map_directory=map_directory,
+                        roughness_average=roughness_average)
+    return outputs
+
+def main():
+    parser = argparse.ArgumentParser(description="Slice, reclassify and regrid the global land cover to the model grid in one pass.")
+    parser.add_argument('--input', default=global_land_use_file, help="Global ESA CCI land cover NetCDF file.")
+    parser.add_argument('--grid', default=model_grid_file, help="NetCDF file on the model grid.")
+    parser.add_argument('--output', default=output_file, help="Output land use NetCDF file on the model grid.")
+    parser.add_argument('--chunk-rows', type=int, default=row_chunk, help="Rows (latitudes) processed at once.")
+    parser.add_argument('--checkpoint-directory', default=None, help="Directory for the block checkpoints.")
+    parser.add_argument('--keep-checkpoints', action='store_true', help="Keep the checkpoints after the output is written.")
+    parser.add_argument('--map-directory', default=None, help="Directory caching the fine to model grid aggregation matrices.")
+    parser.add_argument('--roughness-average', choices=['log', 'area'], default=roughness_average,
+                        help="Average of the class friction coefficients in mixed cells.")
+    parser.add_argument('--epoch', nargs=2, action='append', metavar=('YEAR', 'FILE'),
+                        help="Land cover epoch and its global file; repeat for a stack of epochs, each written "
+                             "incrementally as remaped_land_{YEAR}.nc next to --output, for final.py --land-use-epochs. Replaces --input.")
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.epoch:
+        run_epochs({int(year): epoch_file for year, epoch_file in args.epoch}, args.grid,
+                   os.path.dirname(os.path.abspath(args.output)), chunk_rows=args.chunk_rows,
+                   map_directory=args.map_directory, roughness_average=args.roughness_average)
+    else:
+        run_pipeline(args.input, args.grid, args.output, chunk_rows=args.chunk_rows,
+                     checkpoint_directory=args.checkpoint_directory, keep_checkpoints=args.keep_checkpoints,
+                     map_directory=args.map_directory, roughness_average=args.roughness_average)
+    end = time.time()
+    print(f'elapsed time is {end - start} seconds')
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,213 @@
+import argparse
+import numpy as np
 import xarray as xr
-import time 
+import time
+from netCDF4 import Dataset
 
-start = time.time()
-
-# Define the geographic boundaries of the UK
+# Define the geographic boundaries of the UK as (min_lon, min_lat, max_lon, max_lat)
 min_lon, max_lon = -10, 2
+min_lat, max_lat = 49, 61
+uk_bbox = (min_lon, min_lat, max_lon, max_lat)
 
 # Path to the original NetCDF file
 file_path = '/Users/jamesquessy/Desktop/Uni Work/Masters/Reasearch Project/Code/Power_Generation/land_use/land_use.nc'
 output_path = '/Users/jamesquessy/Desktop/Uni Work/Masters/Reasearch Project/Code/Power_Generation/land_use/sliced_land_use_uk.nc'
 
-# Open the NetCDF file
-with xr.open_dataset(file_path) as ds:
-    # Check the actual range of latitude and longitude in the dataset
-    print("Actual latitude range:", ds.lat.min().values, "to", ds.lat.max().values)
+row_chunk = 2048  # Rows (latitudes) read from the source file at once.
+complevel = 4  # zlib compression level of the sliced files.
+
+# Encoding settings kept from the source file; chunk sizes and compression are set for the slice.
+kept_encoding = ('dtype', '_FillValue', 'scale_factor', 'add_offset', '_Unsigned', 'units', 'calendar')
+
+def region_bounds(region):
+    """
+    Return the (min_lon, min_lat, max_lon, max_lat) bounding box of a region.
+
+    Parameters:
+    - region: Bounding box tuple, a shapely geometry (its .bounds) or a GeoDataFrame/GeoSeries (its .total_bounds).
+
+    Returns:
+    - Tuple of (min_lon, min_lat, max_lon, max_lat).
+    """
+    if hasattr(region, 'total_bounds'):
+        region = region.total_bounds
+    elif hasattr(region, 'bounds'):
+        region = region.bounds
+    bounds = tuple(float(value) for value in region)
+    if len(bounds) != 4 or bounds[0] > bounds[2] or bounds[1] > bounds[3]:
+        raise ValueError(f"Invalid bounding box {bounds}, expected (min_lon, min_lat, max_lon, max_lat)")
+    return bounds
+
+def bbox_indexers(ds, bbox):
+    """
+    Build positional indexers selecting a bounding box, for ascending or descending coordinates.
+
+    Parameters:
+    - ds: Dataset with 'lat' and 'lon' coordinates.
+    - bbox: Tuple of (min_lon, min_lat, max_lon, max_lat).
+
+    Returns:
+    - Dictionary of 'lat' and 'lon' slices for `Dataset.isel`.
+    """
+    bbox_min_lon, bbox_min_lat, bbox_max_lon, bbox_max_lat = bbox
+    indexers = {}
+    for name, low, high in (('lat', bbox_min_lat, bbox_max_lat), ('lon', bbox_min_lon, bbox_max_lon)):
+        inside = np.flatnonzero((ds[name].values >= low) & (ds[name].values <= high))
+        if inside.size == 0:
+            raise ValueError(f"Bounding box {bbox} does not overlap the {name} range of the dataset")
+        indexers[name] = slice(inside[0], inside[-1] + 1)
+    return indexers
+
+def dim_indexers(variable, **indexers):
+    """
+    Keep the indexers of the dimensions a variable has.
+
+    Parameters:
+    - variable: Variable or DataArray to index.
+    - indexers: Indexer of each dimension, e.g. lat=slice(0, 10), lon=slice(5, 20).
+
+    Returns:
+    - Dictionary of indexers for `isel`.
+    """
+    return {dim: indexer for dim, indexer in indexers.items() if dim in variable.dims}
+
+def create_region_file(sliced_ds, output_path, row_variables, complevel=complevel):
+    """
+    Create an output file with the coordinates and small variables of a slice and empty, compressed row variables.
+
+    Parameters:
+    - sliced_ds: Lazily sliced dataset of the region.
+    - output_path: Output NetCDF file.
+    - row_variables: Variables with a 'lat' dimension, filled in later chunk by chunk.
+    - complevel: zlib compression level of the row variables.
+
+    Returns:
+    - Dictionary of row variable -> encoding used to write its chunks.
+    """
+    # Coordinates and variables without a latitude dimension are small and written directly
+    sliced_ds.drop_vars(row_variables).to_netcdf(output_path)
+
+    encodings = {}
+    with Dataset(output_path, 'a') as nc:
+        for name in row_variables:
+            variable = sliced_ds[name].variable
+            for dim, size in variable.sizes.items():
+                if dim not in nc.dimensions:
+                    nc.createDimension(dim, size)
+
+            # Encode one value to get the stored data type and attributes, as xarray would write them
+            encodings[name] = {key: value for key, value in variable.encoding.items() if key in kept_encoding}
+            sample = variable[tuple(slice(0, 1) for _ in variable.dims)].load()
+            sample.encoding = dict(encodings[name])
+            encoded = xr.conventions.encode_cf_variable(sample, name=name)
+            attrs = dict(encoded.attrs)
+            fill_value = attrs.pop('_FillValue', None)
+            nc_variable = nc.createVariable(name, encoded.dtype, variable.dims, zlib=True, complevel=complevel, fill_value=fill_value)
+            nc_variable.setncatts(attrs)
+    return encodings
+
+def slice_regions(file_path, regions, chunk_rows=row_chunk, complevel=complevel):
+    """
+    Write the subset of a land use file for several bounding boxes from a single read of the file.
+
+    The rows covering the regions are read in blocks of `chunk_rows` latitudes, each block only
+    over the longitudes of the regions overlapping it. Every block is read once and written into
+    all of those regions before the next one is read, so peak memory is one block, not the file.
+
+    Parameters:
+    - file_path: Source NetCDF file with 'lat' and 'lon' coordinates.
+    - regions: Dictionary of output path -> region (see `region_bounds`).
+    - chunk_rows: Rows (latitudes) read at once.
+    - complevel: zlib compression level of the outputs.
+
+    Returns:
+    - Dictionary of output path -> (min_lon, min_lat, max_lon, max_lat) written.
+    """
+    written = {}
+    with xr.open_dataset(file_path) as ds:
+        # Check the actual range of latitude and longitude in the dataset
+        print("Actual latitude range:", ds.lat.min().values, "to", ds.lat.max().values)
+        print("Actual longitude range:", ds.lon.min().values, "to", ds.lon.max().values)
+
+        region_indexers = {}
+        for region_output_path, region in regions.items():
+            written[region_output_path] = region_bounds(region)
+            region_indexers[region_output_path] = bbox_indexers(ds, written[region_output_path])
+
+        # Create the outputs, then fill their row variables block by block
+        row_variables = [name for name, variable in ds.data_vars.items() if 'lat' in variable.dims]
+        encodings = {path: create_region_file(ds.isel(indexers), path, row_variables, complevel)
+                     for path, indexers in region_indexers.items()}
+        outputs = {path: Dataset(path, 'a') for path in region_indexers}
+        try:
+            for output in outputs.values():
+                output.set_auto_maskandscale(False)
+
+            first_row = min(indexers['lat'].start for indexers in region_indexers.values())
+            last_row = max(indexers['lat'].stop for indexers in region_indexers.values())
+            for row_start in range(first_row, last_row, chunk_rows):
+                rows = slice(row_start, min(row_start + chunk_rows, last_row))
+                overlapping = {path: indexers for path, indexers in region_indexers.items()
+                               if indexers['lat'].start < rows.stop and indexers['lat'].stop > rows.start}
+                if not overlapping:
+                    continue
+                columns = slice(min(indexers['lon'].start for indexers in overlapping.values()),
+                                max(indexers['lon'].stop for indexers in overlapping.values()))
+
+                for name in row_variables:
+                    # Read the block once and write its part of every overlapping region; variables
+                    # such as lat_bounds(lat, bounds) are only sliced along the dims they have
+                    variable = ds[name].variable
+                    block = variable.isel(dim_indexers(variable, lat=rows, lon=columns)).load()
+                    for path, indexers in overlapping.items():
+                        lat_start, lat_stop = max(rows.start, indexers['lat'].start), min(rows.stop, indexers['lat'].stop)
+                        part = block.isel(dim_indexers(block, lat=slice(lat_start - rows.start, lat_stop - rows.start),
+                                                       lon=slice(indexers['lon'].start - columns.start, indexers['lon'].stop - columns.start)))
+                        part.encoding = dict(encodings[path][name])
+                        encoded = xr.conventions.encode_cf_variable(part, name=name)
+                        target = tuple(slice(lat_start - indexers['lat'].start, lat_stop - indexers['lat'].start) if dim == 'lat'
+                                       else slice(None) for dim in part.dims)
+                        outputs[path].variables[name][target] = encoded.values
+        finally:
+            for output in outputs.values():
+                output.close()
+
+    for region_output_path, bbox in written.items():
+        print(f"Saved {bbox} to {region_output_path}")
+    return written
+
+def slice_region(file_path, output_path, region=uk_bbox, chunk_rows=row_chunk, complevel=complevel):
+    """
+    Write the subset of a land use file for one bounding box.
+
+    Parameters:
+    - file_path: Source NetCDF file with 'lat' and 'lon' coordinates.
+    - output_path: Output NetCDF file.
+    - region: Region to keep (see `region_bounds`), the UK by default.
+    - chunk_rows: Rows (latitudes) read at once.
+    - complevel: zlib compression level of the output.
+    """
+    slice_regions(file_path, {output_path: region}, chunk_rows=chunk_rows, complevel=complevel)
+
+def main():
+    parser = argparse.ArgumentParser(description="Slice one or more bounding boxes out of a land use file in a single read.")
+    parser.add_argument('--input', default=file_path, help="Source land use NetCDF file.")
+    parser.add_argument('--bbox', nargs=4, type=float, action='append', metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+                        help="Bounding box to slice; repeat together with --output for several regions. Defaults to the UK.")
+    parser.add_argument('--output', action='append', help="Output file for each --bbox, in the same order.")
+    parser.add_argument('--chunk-rows', type=int, default=row_chunk, help="Rows (latitudes) read at once.")
+    parser.add_argument('--complevel', type=int, default=complevel, help="zlib compression level of the outputs.")
+    args = parser.parse_args()
 
-    # Select the subset of the data for the UK
-    sliced_ds1 = ds.sel(lon=slice(min_lon, max_lon))
+    bboxes = args.bbox or [uk_bbox]
+    outputs = args.output or [output_path]
+    if len(bboxes) != len(outputs):
+        parser.error("Give one --output for each --bbox")
 
-    # Save the sliced data to a new file
-    sliced_ds1.to_netcdf(output_path)
+    start = time.time()
+    slice_regions(args.input, dict(zip(outputs, bboxes)), chunk_rows=args.chunk_rows, complevel=args.complevel)
+    end = time.time()
+    print(f'elapsed time is {end - start} seconds')
 
-end = time.time()
-print(f'elapsed time is {end - start} seconds')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,478 @@
+import argparse
+import json
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import xarray as xr
+from scipy.special import gamma
 
-def extract_last_year(file_path, new_folder, var_name, year):
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Define the base path
+original_file_path = '/Users/jamesquessy/Desktop/Uni Work/Masters/Reasearch Project/Code/Power_Generation /NetCDF_Files'
+
+# Define the new folder
+new_folder = '/Users/jamesquessy/Desktop/Uni Work/Masters/Reasearch Project/Code/Power_Generation/last_year_avg'
+
+# List of years and variables to process
+years = ['2020', '2050', '2075', '2099']
+variables = ['tas', 'hurs', 'sfcWind', 'ps']
+scenarios = ['2.6', '4.5', '8.5']  # Used by the batch API; each scenario reads and writes its own RCP_{rcp} subfolder.
+
+# Source file name for each variable and year; years that map to the same file are read in one pass
+file_pattern = "{var_name}_{year}_remap.nc"
+
+time_chunk = 64  # Time steps read from the source file at once.
+climatology_years = 1  # Length of the centred averaging window in years, e.g. 20 for 2041-2060 around 2050.
+wind_variable = 'sfcWind'  # Variable the wind distribution statistics are computed for.
+wind_moments = False  # Also write {wind_variable}_{year}_wind_moments.nc with the mean of v³ and Weibull parameters.
+
+# Attributes of the wind distribution statistics, saved as {wind_variable}_{name}
+wind_statistics_attributes = {
+    'cubed_mean': {'long_name': 'Mean of the cubed wind speed', 'units': 'm3 s-3'},
+    'std': {'long_name': 'Standard deviation of the wind speed', 'units': 'm s-1'},
+    'weibull_k': {'long_name': 'Weibull shape parameter', 'units': '1'},
+    'weibull_c': {'long_name': 'Weibull scale parameter', 'units': 'm s-1'},
+    'weibull_cubed_mean': {'long_name': 'Mean of the cubed wind speed of the fitted Weibull distribution', 'units': 'm3 s-3'}
+}
+workers = 1  # Worker processes for the batch API, further limited by the available memory.
+manifest_file_name = '.extract_manifest.json'  # Records the source file each output was built from.
+
+def yearly_average_template(data_array):
+    """
+    Build an empty yearly average with the coordinates the time mean of the variable would keep.
+
+    Parameters:
+    - data_array: Variable with a 'time' dimension.
+
+    Returns:
+    - DataArray without the 'time' dimension or any time-dependent coordinates.
+    """
+    time_coords = [name for name, coord in data_array.coords.items() if 'time' in coord.dims]
+    return data_array.drop_vars(time_coords).isel(time=0, drop=True)
 
+def climatology_window(year, window):
+    """
+    Return the first and last year of the centred climatology window for a target year.
+
+    Parameters:
+    - year: Target year, e.g. 2050.
+    - window: Window length in years; 1 is the calendar year itself.
+
+    Returns:
+    - Tuple (first_year, last_year), e.g. (2041, 2060) for 2050 and a 20-year window.
+    """
+    first_year = int(year) - (window - 1) // 2
+    return first_year, first_year + window - 1
+
+def wind_distribution_statistics(mean, second_moment, third_moment):
+    """
+    Derive wind distribution statistics from the first three raw moments of the wind speed.
+
+    The Weibull shape k is estimated from the coefficient of variation with the empirical
+    relation k = (std / mean)^-1.086 of Justus et al. (1978), clipped to 1-10 where it holds,
+    and the scale c = mean / Γ(1 + 1/k).
+
+    Parameters:
+    - mean: Mean wind speed (m/s).
+    - second_moment: Mean of the squared wind speed.
+    - third_moment: Mean of the cubed wind speed.
+
+    Returns:
+    - Dictionary with the 'cubed_mean', 'std', 'weibull_k', 'weibull_c' and 'weibull_cubed_mean' arrays.
+    """
+    std = np.sqrt(np.maximum(second_moment - mean ** 2, 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weibull_k = np.clip((std / mean) ** -1.086, 1, 10)
+        weibull_k = np.where(mean > 0, weibull_k, np.nan)
+        weibull_c = mean / gamma(1 + 1 / weibull_k)
+    return {
+        'cubed_mean': third_moment,
+        'std': std,
+        'weibull_k': weibull_k,
+        'weibull_c': weibull_c,
+        'weibull_cubed_mean': weibull_c ** 3 * gamma(1 + 3 / weibull_k)
+    }
+
+def extract_years(file_path, new_folder, var_name, years, time_chunk=time_chunk, window=climatology_years, moments=False):
+    """
+    Average a variable over the climatology window of each requested year in a single streaming pass over the file.
+
+    The file is opened once and only the time steps inside a window are read, in blocks of
+    `time_chunk` time steps, while a running (cumulative) sum and count of the valid values is
+    kept. The cumulative totals are saved at the year boundaries of every window and carried
+    unchanged across the years between windows, so each window mean is the difference of two
+    saved totals: all windows for all years come out of the same pass, and peak memory is one
+    block plus two grids per requested year.
+
+    With `moments`, the sums of the squared and cubed values are kept in the same pass and the
+    mean of v³ and the Weibull parameters are written to {var_name}_{year}_wind_moments.nc, so
+    the expected power can be computed without keeping the sub-annual data.
+
+    Parameters:
+    - file_path: Source NetCDF file with a 'time' dimension, sorted in time.
+    - new_folder: Folder the averages are written to, as {var_name}_{year}_yearly_avg.nc.
+    - var_name: Variable to average.
+    - years: Years to average, as strings or integers.
+    - time_chunk: Number of time steps read at once.
+    - window: Climatology window length in years, centred on each year; windows reaching past
+      the data in the file are truncated to it.
+    - moments: Also write the wind distribution statistics from `wind_distribution_statistics`.
+
+    Returns:
+    - List of the written file paths.
+    """
     # Create the folder if it doesn't exist
     if not os.path.exists(new_folder):
         os.makedirs(new_folder)
 
-    # Path for the new file
-    new_file_path = os.path.join(new_folder, f"{var_name}_{year}_yearly_avg.nc")
+    written = []
+    with xr.open_dataset(file_path, engine='netcdf4') as data:
+        variable = data[var_name]
+        time_axis = variable.get_axis_num('time')
+        file_years = data['time'].dt.year.values
+        if np.any(np.diff(file_years) < 0):
+            raise ValueError(f"Time axis of {file_path} is not sorted")
 
-    # Load the dataset
-    data = xr.open_dataset(file_path, engine='netcdf4')
+        windows = {int(year): climatology_window(year, window) for year in years}
+        # Cumulative totals are needed through the year before each window and through its last year
+        boundaries = sorted({first_year - 1 for first_year, _ in windows.values()} | {last_year for _, last_year in windows.values()})
 
-    # Select the data for the specific year
-    yearly_data = data.sel(time=data.time.dt.year == int(year))
+        # Running sum (of v, and of v² and v³ with moments) and count of the valid (non-NaN) values,
+        # and their value at each boundary year
+        template = yearly_average_template(variable)
+        n_moments = 3 if moments else 1
+        cumulative_sum = np.zeros((n_moments,) + template.shape, dtype=np.float64)
+        cumulative_count = np.zeros(template.shape, dtype=np.int64)
+        totals = {}
 
-    # Compute the average for the year
-    avg_data = yearly_data[var_name].mean(dim='time')
+        def reach(next_year):
+            # Everything read so far lies before next_year, so it is the total through every earlier boundary
+            while len(totals) < len(boundaries) and boundaries[len(totals)] < next_year:
+                totals[boundaries[len(totals)]] = (cumulative_sum.copy(), cumulative_count.copy())
 
-    # Create a new dataset with the average data
-    avg_dataset = xr.Dataset({var_name: avg_data})
-    avg_dataset.attrs = data.attrs
+        # Only the time steps inside a window are read; no window difference spans the years
+        # between windows, so the running totals are carried across them without reading them
+        in_window = np.zeros(file_years.shape, dtype=bool)
+        for first_year, last_year in windows.values():
+            in_window |= (file_years >= first_year) & (file_years <= last_year)
+        selected = np.flatnonzero(in_window)
+        gaps = np.flatnonzero(np.diff(selected) > 1)
+        read_ranges = zip(selected[np.r_[0, gaps + 1]], selected[np.r_[gaps, len(selected) - 1]] + 1) if selected.size else []
+        for range_start, range_stop in read_ranges:
+            for start in range(range_start, range_stop, time_chunk):
+                stop = min(start + time_chunk, range_stop)
+                block = variable.isel(time=slice(start, stop)).values
+                block_years = file_years[start:stop]
+                # Split the block into runs of the same year
+                run_starts = np.flatnonzero(np.r_[True, block_years[1:] != block_years[:-1]])
+                for run_start, run_stop in zip(run_starts, np.r_[run_starts[1:], len(block_years)]):
+                    reach(block_years[run_start])
+                    values = np.take(block, np.arange(run_start, run_stop), axis=time_axis)
+                    valid = ~np.isnan(values)
+                    filled = np.where(valid, values, 0)
+                    if moments:
+                        filled = filled.astype(np.float64)
+                    power = filled
+                    for moment in range(n_moments):
+                        if moment:
+                            power = power * filled
+                        cumulative_sum[moment] += power.sum(axis=time_axis, dtype=np.float64)
+                    cumulative_count += valid.sum(axis=time_axis)
+        reach(np.inf)
 
-    # Save the average data to the new file path
-    avg_dataset.to_netcdf(new_file_path)
-    print(f"Saved {new_file_path}")
+        for year, (first_year, last_year) in sorted(windows.items()):
+            covered = file_years[(file_years >= first_year) & (file_years <= last_year)]
+            if covered.size == 0:
+                print(f"No data for {year} in {file_path}")
+                continue
+            if window > 1 and (covered[0] > first_year or covered[-1] < last_year):
+                print(f"Window for {year} truncated to {covered[0]}-{covered[-1]} in {file_path}")
 
-# Define the base path
-original_file_path = '/Users/jamesquessy/Desktop/Uni Work/Masters/Reasearch Project/Code/Power_Generation /NetCDF_Files'
+            # Path for the new file
+            new_file_path = os.path.join(new_folder, f"{var_name}_{year}_yearly_avg.nc")
 
-# Define the new folder
-new_folder = '/Users/jamesquessy/Desktop/Uni Work/Masters/Reasearch Project/Code/Power_Generation/last_year_avg'
+            # Compute the average over the window, NaN where a cell has no valid values
+            window_sum = totals[last_year][0] - totals[first_year - 1][0]
+            window_count = totals[last_year][1] - totals[first_year - 1][1]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                raw_moments = np.where(window_count > 0, window_sum / window_count, np.nan)
+            dtype = np.result_type(variable.dtype, np.float32)
+            avg_data = template.copy(data=raw_moments[0].astype(dtype))
+            if window > 1:
+                avg_data.attrs['climatology_window'] = f"{covered[0]}-{covered[-1]}"
 
-# List of years and variables to process
-years = ['2020', '2050', '2075', '2099']
-variables = ['tas', 'hurs', 'sfcWind', 'ps']
+            # Create a new dataset with the average data
+            avg_dataset = xr.Dataset({var_name: avg_data})
+            avg_dataset.attrs = data.attrs
+
+            # Save the average data to the new file path
+            avg_dataset.to_netcdf(new_file_path)
+            print(f"Saved {new_file_path}")
+            written.append(new_file_path)
+
+            if moments:
+                # Save the wind distribution statistics next to the average
+                statistics = wind_distribution_statistics(*raw_moments)
+                moments_dataset = xr.Dataset({
+                    f"{var_name}_{name}": xr.DataArray(values.astype(dtype), coords=template.coords, dims=template.dims,
+                                                       attrs=wind_statistics_attributes[name])
+                    for name, values in statistics.items()
+                })
+                moments_dataset.attrs = dict(data.attrs, **{'climatology_window': f"{covered[0]}-{covered[-1]}"})
+                moments_file_path = os.path.join(new_folder, f"{var_name}_{year}_wind_moments.nc")
+                moments_dataset.to_netcdf(moments_file_path)
+                print(f"Saved {moments_file_path}")
+                written.append(moments_file_path)
+
+    return written
+
+def extract_last_year(file_path, new_folder, var_name, year):
+    """
+    Average a variable over one calendar year.
+
+    Parameters:
+    - file_path: Source NetCDF file with a 'time' dimension.
+    - new_folder: Folder the yearly average is written to.
+    - var_name: Variable to average.
+    - year: Year to average.
+    """
+    extract_years(file_path, new_folder, var_name, [year])
+
+def source_files(original_file_path, var_name, years, file_pattern=file_pattern):
+    """
+    Group the requested years by the source file holding them.
+
+    Parameters:
+    - original_file_path: Folder containing the source files.
+    - var_name: Variable name used in the file pattern.
+    - years: Years to process.
+    - file_pattern: Source file name pattern with {var_name} and {year} fields.
+
+    Returns:
+    - Dictionary mapping each source file path to the years read from it.
+    """
+    files = {}
+    for year in years:
+        file_name = file_pattern.format(var_name=var_name, year=year)
+        files.setdefault(os.path.join(original_file_path, file_name), []).append(year)
+    return files
+
+def scenario_folder(folder, rcp):
+    """
+    Return the folder for an RCP scenario, following the RCP_{rcp} layout used by final.py.
+
+    Parameters:
+    - folder: Base folder.
+    - rcp: The RCP scenario as a string, or None for the base folder itself.
+
+    Returns:
+    - Folder path for the scenario.
+    """
+    return folder if rcp is None else os.path.join(folder, f"RCP_{rcp}")
+
+def available_memory():
+    """
+    Return the memory currently available to new processes in bytes, or None if it is unknown.
+    """
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def estimate_job_memory(file_path, var_name, n_years, time_chunk=time_chunk, moments=False):
+    """
+    Estimate the peak memory of `extract_years` from the file header, without reading any data.
+
+    Parameters:
+    - file_path: Source NetCDF file.
+    - var_name: Variable to average.
+    - n_years: Number of years averaged from the file.
+    - time_chunk: Number of time steps read at once.
+    - moments: Whether the wind distribution statistics are computed as well.
+
+    Returns:
+    - Estimated peak memory in bytes.
+    """
+    with xr.open_dataset(file_path, engine='netcdf4') as data:
+        variable = data[var_name]
+        grid_cells = variable.size // variable.sizes['time'] if variable.sizes['time'] else variable.size
+        itemsize = variable.dtype.itemsize
+    # The time block and its per-year copies, plus the running float64 sums and int64 count and two saved totals per year
+    n_moments = 3 if moments else 1
+    block_bytes = 3 * time_chunk * grid_cells * (8 if moments else itemsize)
+    return block_bytes + (2 * n_years + 1) * grid_cells * 8 * (n_moments + 1)
+
+def read_manifest(folder):
+    manifest_file_path = os.path.join(folder, manifest_file_name)
+    if not os.path.isfile(manifest_file_path):
+        return {}
+    with open(manifest_file_path) as f:
+        return json.load(f)
+
+def write_manifest(folder, manifest):
+    # Write to a temporary file first so an interrupted run never leaves a partial manifest
+    manifest_file_path = os.path.join(folder, manifest_file_name)
+    temp_file_path = f"{manifest_file_path}.{os.getpid()}.tmp"
+    with open(temp_file_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_file_path, manifest_file_path)
+
+def source_signature(file_path):
+    stat = os.stat(file_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+def is_up_to_date(file_path, new_folder, var_name, years, window, moments, manifest):
+    """
+    Check whether the outputs of a job were built from the current version of its source file.
+
+    Parameters:
+    - file_path: Source NetCDF file.
+    - new_folder: Folder the yearly averages are written to.
+    - var_name: Variable to average.
+    - years: Years averaged from the file.
+    - window: Climatology window length in years.
+    - moments: Whether the wind distribution statistics are needed.
+    - manifest: Manifest of the output folder, from `read_manifest`.
+
+    Returns:
+    - True if the source mtime and size are unchanged and every output still exists.
+    """
+    entry = manifest.get(os.path.abspath(file_path))
+    if entry is None or entry['var_name'] != var_name or entry.get('window', 1) != window:
+        return False
+    if moments and not entry.get('moments', False):
+        return False
+    if entry['source'] != source_signature(file_path):
+        return False
+    if not {str(year) for year in years} <= set(entry['years']):
+        return False
+    return all(os.path.isfile(os.path.join(new_folder, name)) for name in entry['outputs'])
+
+def _run_extract_job(file_path, new_folder, var_name, years, moments, time_chunk, window):
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    written = extract_years(file_path, new_folder, var_name, years, time_chunk=time_chunk, window=window, moments=moments)
+    return written, time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+def extract_batch(variables=variables, years=years, scenarios=None, source_folder=original_file_path, output_folder=new_folder,
+                  file_pattern=file_pattern, workers=workers, time_chunk=time_chunk, window=climatology_years,
+                  moments=wind_moments, force=False):
+    """
+    Extract the yearly averages for every variable, year and scenario, skipping outputs that are up to date.
+
+    Each source file is one job, averaged for all of its years in one pass by `extract_years`.
+    Jobs run on a process pool whose size is limited by `workers`, the CPU count and the memory
+    available for the estimated peak memory of the largest job. The throughput of each file is
+    reported in MB/s with the CPU share of the wall time: a CPU share well below 100% means the
+    extraction is waiting on I/O.
+
+    Parameters:
+    - variables: Variables to process.
+    - years: Years to process.
+    - scenarios: RCP scenarios to process from RCP_{rcp} subfolders, or None to use the folders directly.
+    - source_folder: Folder containing the source files.
+    - output_folder: Folder the yearly averages are written to.
+    - file_pattern: Source file name pattern with {var_name} and {year} fields.
+    - workers: Maximum number of worker processes; 1 runs every job in this process.
+    - time_chunk: Number of time steps read at once.
+    - window: Climatology window length in years; windows longer than 1 need a multi-year file pattern.
+    - moments: Also write the wind distribution statistics of `wind_variable` in the same pass.
+    - force: Rebuild outputs even if they are up to date.
+
+    Returns:
+    - List of the written file paths.
+    """
+    # Build one job per source file and skip the ones whose outputs are up to date
+    jobs = []
+    manifests = {}
+    for rcp in (scenarios or [None]):
+        job_source_folder = scenario_folder(source_folder, rcp)
+        job_output_folder = scenario_folder(output_folder, rcp)
+        manifest = manifests.setdefault(job_output_folder, read_manifest(job_output_folder))
+        for var_name in variables:
+            job_moments = moments and var_name == wind_variable
+            for file_path, file_years in source_files(job_source_folder, var_name, years, file_pattern).items():
+                if not os.path.isfile(file_path):
+                    print(f"File not found: {file_path}")
+                elif not force and is_up_to_date(file_path, job_output_folder, var_name, file_years, window, job_moments, manifest):
+                    print(f"Up to date: {file_path}")
+                else:
+                    jobs.append((file_path, job_output_folder, var_name, file_years, job_moments))
+    if not jobs:
+        return []
+
+    # Limit the pool so the estimated peak memory of the running jobs fits in the available memory
+    job_workers = min(workers, len(jobs), os.cpu_count() or 1)
+    memory = available_memory()
+    if job_workers > 1 and memory is not None:
+        peak = max(estimate_job_memory(file_path, var_name, len(file_years), time_chunk, job_moments)
+                   for file_path, _, var_name, file_years, job_moments in jobs)
+        job_workers = max(1, min(job_workers, memory // max(peak, 1)))
+    print(f"Extracting {len(jobs)} files with {job_workers} worker(s)")
+
+    def record(job, result):
+        file_path, job_output_folder, var_name, file_years, job_moments = job
+        written, seconds, cpu_seconds = result
+        size_mb = os.path.getsize(file_path) / 1e6
+        print(f"{os.path.basename(file_path)}: {size_mb:.1f} MB in {seconds:.2f} s "
+              f"({size_mb / max(seconds, 1e-9):.1f} MB/s, CPU {cpu_seconds / max(seconds, 1e-9) * 100:.0f}%)")
+        manifest = manifests[job_output_folder]
+        manifest[os.path.abspath(file_path)] = {
+            'var_name': var_name,
+            'years': [str(year) for year in file_years],
+            'window': window,
+            'moments': job_moments,
+            'outputs': [os.path.basename(path) for path in written],
+            'source': source_signature(file_path)
+        }
+        write_manifest(job_output_folder, manifest)
+        return written
+
+    written = []
+    if job_workers <= 1:
+        for job in jobs:
+            written += record(job, _run_extract_job(*job, time_chunk, window))
+    else:
+        # Spawn rather than fork so workers do not inherit open NetCDF/HDF5 handles
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=job_workers, mp_context=context) as executor:
+            futures = {executor.submit(_run_extract_job, *job, time_chunk, window): job for job in jobs}
+            for future in as_completed(futures):
+                written += record(futures[future], future.result())
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract yearly averages of the climate variables.")
+    parser.add_argument('--var', nargs='+', default=variables, help="Variables to process.")
+    parser.add_argument('--years', nargs='+', default=years, help="Years to process.")
+    parser.add_argument('--rcp', nargs='+', default=None,
+                        help="RCP scenarios to process from RCP_{rcp} subfolders, e.g. 2.6 4.5 8.5.")
+    parser.add_argument('--source-folder', default=original_file_path, help="Folder containing the source files.")
+    parser.add_argument('--output-folder', default=new_folder, help="Folder the yearly averages are written to.")
+    parser.add_argument('--file-pattern', default=file_pattern,
+                        help="Source file name pattern with {var_name} and {year} fields.")
+    parser.add_argument('--workers', type=int, default=workers, help="Maximum number of worker processes.")
+    parser.add_argument('--time-chunk', type=int, default=time_chunk, help="Time steps read from the source file at once.")
+    parser.add_argument('--window', type=int, default=climatology_years,
+                        help="Average over a centred window of this many years (e.g. 20 gives 2041-2060 for 2050) "
+                             "instead of the calendar year, written to the same files.")
+    parser.add_argument('--moments', action='store_true', default=wind_moments,
+                        help=f"Also write the mean of v³ and Weibull parameters of {wind_variable} for the expected power "
+                             "(final.py --wind-statistic).")
+    parser.add_argument('--force', action='store_true', help="Rebuild outputs even if they are up to date.")
+    args = parser.parse_args()
+
+    # Process each source file once for all of its years and save the averages
+    extract_batch(args.var, args.years, scenarios=args.rcp, source_folder=args.source_folder, output_folder=args.output_folder,
+                  file_pattern=args.file_pattern, workers=args.workers, time_chunk=args.time_chunk, window=args.window,
+                  moments=args.moments, force=args.force)
 
-# Loop through each year and variable, process the file and save the average
-for year in years:
-    for var_name in variables:
-        file_name = f"{var_name}_{year}_remap.nc" 
-        file_path = os.path.join(original_file_path, file_name)
-        if os.path.isfile(file_path):
-            extract_last_year(file_path, new_folder, var_name, year)
-        else:
-            print(f"File not found: {file_path}")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import numpy as np
+
+# Point Gridding
+# Assigns point datasets (airports, turbines, substations, cities) to the cells of a lat/lon
+# grid in one vectorized pass: every point gets integer cell indices at once, and the points of
+# each cell are counted with a single scatter-add instead of a loop over the rows.
+
+def cell_index(values, centres):
+    """
+    Find the model grid cell containing each coordinate value.
+
+    The cell edges are halfway between the centres, and half a step beyond the first and last centre.
+
+    Parameters:
+    - values: Coordinate values, e.g. of a fine grid or of points.
+    - centres: Model grid cell centres, ascending or descending.
+
+    Returns:
+    - Array of cell indices, -1 for values outside the grid.
+    """
+    order = np.argsort(centres)
+    ordered = np.asarray(centres, dtype=np.float64)[order]
+    if len(ordered) > 1:
+        edges = np.concatenate([[1.5 * ordered[0] - 0.5 * ordered[1]], (ordered[1:] + ordered[:-1]) / 2,
+                                [1.5 * ordered[-1] - 0.5 * ordered[-2]]])
+    else:
+        edges = np.array([-np.inf, np.inf])
+    position = np.searchsorted(edges, values, side='right') - 1
+    inside = (position >= 0) & (position < len(ordered))
+    return np.where(inside, order[np.clip(position, 0, len(ordered) - 1)], -1)
+
+def grid_indices(point_lats, point_lons, lat, lon):
+    """
+    Find the grid cell of every point.
+
+    Parameters:
+    - point_lats: Latitudes of the points in degrees.
+    - point_lons: Longitudes of the points in degrees.
+    - lat: Latitudes of the grid cell centres, ascending or descending.
+    - lon: Longitudes of the grid cell centres, ascending or descending.
+
+    Returns:
+    - Tuple of (latitude indices, longitude indices, inside), where inside marks the points
+      within the grid; the indices of the other points are -1.
+    """
+    lat_index = cell_index(np.asarray(point_lats, dtype=np.float64), lat)
+    lon_index = cell_index(np.asarray(point_lons, dtype=np.float64), lon)
+    inside = (lat_index >= 0) & (lon_index >= 0)
+    return np.where(inside, lat_index, -1), np.where(inside, lon_index, -1), inside
+
+def snap_to_grid(point_lats, point_lons, lat, lon):
+    """
+    Move every point to the centre of its grid cell.
+
+    Parameters:
+    - point_lats: Latitudes of the points in degrees.
+    - point_lons: Longitudes of the points in degrees.
+    - lat: Latitudes of the grid cell centres.
+    - lon: Longitudes of the grid cell centres.
+
+    Returns:
+    - Tuple of (latitudes, longitudes) of the cell centres, NaN for points outside the grid.
+    """
+    lat_index, lon_index, inside = grid_indices(point_lats, point_lons, lat, lon)
+    return (np.where(inside, np.asarray(lat, dtype=np.float64)[lat_index], np.nan),
+            np.where(inside, np.asarray(lon, dtype=np.float64)[lon_index], np.nan))
+
+def point_counts(point_lats, point_lons, lat, lon, weights=None):
+    """
+    Count the points in every grid cell, or sum their weights.
+
+    Parameters:
+    - point_lats: Latitudes of the points in degrees.
+    - point_lons: Longitudes of the points in degrees.
+    - lat: Latitudes of the grid cell centres.
+    - lon: Longitudes of the grid cell centres.
+    - weights: Optional weight of each point, e.g. the capacity of each turbine.
+
+    Returns:
+    - Array of shape (lat, lon): int32 counts, or float64 sums of the weights. Points outside
+      the grid are left out.
+    """
+    lat_index, lon_index, inside = grid_indices(point_lats, point_lons, lat, lon)
+    if weights is None:
+        counts = np.zeros((len(lat), len(lon)), dtype=np.int32)
+        np.add.at(counts, (lat_index[inside], lon_index[inside]), 1)
+    else:
+        counts = np.zeros((len(lat), len(lon)), dtype=np.float64)
+        np.add.at(counts, (lat_index[inside], lon_index[inside]), np.asarray(weights, dtype=np.float64)[inside])
+    return counts
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import xarray as xr
+import final
+from land_use_change import ipcc_classes
+from land_use_pipeline import land_use_layer
+
+@pytest.fixture
+def model_files(tmp_path, monkeypatch):
+    # A small model grid with every static layer, a fractional land use layer and one year of climate averages
+    rng = np.random.default_rng(0)
+    lat = np.arange(54.0, 56.0, 0.25)
+    lon = np.arange(-4.0, -1.0, 0.25)
+    coords = {'lat': lat, 'lon': lon}
+    shape = (lat.size, lon.size)
+
+    xr.Dataset({'orog': (('lat', 'lon'), rng.uniform(0, 500, shape).astype(np.float32))}, coords=coords).to_netcdf(tmp_path / 'orog.nc')
+    xr.Dataset({'sftlf': (('lat', 'lon'), np.full(shape, 100, np.float32))}, coords=coords).to_netcdf(tmp_path / 'sftlf.nc')
+    classes = sorted(ipcc_classes)
+    class_area = rng.uniform(0, 1, shape + (len(classes),)) ** 4
+    # Store the class fractions in several chunks along ipcc_class, as netCDF does for a full-size grid
+    land_use_layer(class_area, xr.Dataset(coords=coords), classes).to_netcdf(
+        tmp_path / 'land_use.nc', encoding={'land_cover_fraction': {'zlib': True, 'chunksizes': (4, 4, 6)}}
+    )
+    xr.Dataset({name: (('lat', 'lon'), (rng.random(shape) < 0.1).astype(np.uint8)) for name in ('nsa', 'spa')},
+               coords=coords).to_netcdf(tmp_path / 'constraint_masks.nc')
+    xr.Dataset({'airport': (('lat', 'lon'), (rng.random(shape) < 0.05).astype(float))}, coords=coords).to_netcdf(tmp_path / 'airport_mask.nc')
+
+    climate_directory = tmp_path / 'climate'
+    climate_directory.mkdir()
+    ranges = {'hurs': (40, 100), 'ps': (95000, 103000), 'sfcWind': (2, 12), 'tas': (270, 290)}
+    for variable, (low, high) in ranges.items():
+        xr.Dataset({variable: (('lat', 'lon'), rng.uniform(low, high, shape).astype(np.float32))},
+                   coords=coords).to_netcdf(climate_directory / f"{variable}_2020_yearly_avg.nc")
+
+    monkeypatch.setattr(final, 'orography_file_path', str(tmp_path / 'orog.nc'))
+    monkeypatch.setattr(final, 'land_area_file_path', str(tmp_path / 'sftlf.nc'))
+    monkeypatch.setattr(final, 'land_use_file_path', str(tmp_path / 'land_use.nc'))
+    monkeypatch.setattr(final, 'nsa_mask_file_path', str(tmp_path / 'constraint_masks.nc'))
+    monkeypatch.setattr(final, 'spa_mask_file_path', str(tmp_path / 'constraint_masks.nc'))
+    monkeypatch.setattr(final, 'airport_mask_file_path', str(tmp_path / 'airport_mask.nc'))
+    monkeypatch.setattr(final, 'exclusion_cache_directory', str(tmp_path / 'cache'))
+    return tmp_path
+
+def run_year(model_files, name, chunks):
+    directories = {'last_year_avg': str(model_files / 'climate'), 'merged': str(model_files / name),
+                   'final_files': str(model_files / name)}
+    (model_files / name).mkdir()
+    static_layers = final.load_static_layers(chunks=chunks, land_use_epochs=[])
+    friction_coefficient = static_layers['dataset']['friction_coefficient'].values
+    with final.process_year('2020', directories, static_layers) as ds:
+        return friction_coefficient, ds['power_generation'].values
+
+def test_chunked_mode_with_land_cover_fraction(model_files):
+    eager_friction, eager_power = run_year(model_files, 'eager', None)
+    chunked_friction, chunked_power = run_year(model_files, 'chunked', {'lat': 3, 'lon': 5})
+
+    with xr.open_dataset(model_files / 'land_use.nc') as land_use_ds:
+        np.testing.assert_allclose(eager_friction, land_use_ds['friction_coefficient'].values, rtol=1e-6)
+    np.testing.assert_allclose(chunked_friction, eager_friction)
+    np.testing.assert_allclose(chunked_power, eager_power)
+    assert np.count_nonzero(eager_power) > 0
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import xarray as xr
+import final
+from fused_kernel import available_backends, fused_power_generation
+
+# float64 results must agree with the NumPy formulas in final.py to 1e-9 and float32 results to 1e-4
+tolerances = [(np.float64, 1e-9), (np.float32, 1e-4)]
+kernel_constants = {
+    'reference_height': final.reference_height, 'target_height': final.target_height, 'Rd': final.Rd, 'Rv': final.Rv,
+    'Kelvin': final.Kelvin, 'turbine_area': final.turbine_area, 'power_coefficient': final.power_coefficient
+}
+
+@pytest.fixture(scope='module')
+def kernel_inputs():
+    rng = np.random.default_rng(0)
+    shape = (256, 384)
+    inputs = {
+        'sfcWind': rng.uniform(0, 25, shape),
+        'friction_coefficient': rng.choice([0.10, 0.15, 0.20, 0.25, 0.30], size=shape),
+        'ps': rng.uniform(85000, 105000, shape),
+        'tas': rng.uniform(240, 310, shape),
+        'hurs': rng.uniform(0, 100, shape)
+    }
+    expected = final.calculate_power_generation(
+        final.calculate_wind_at_80m(inputs['sfcWind'], inputs['friction_coefficient'], final.reference_height, final.target_height),
+        final.calculate_air_density(inputs['ps'], inputs['tas'], inputs['hurs'], final.Rd, final.Rv, final.Kelvin),
+        final.turbine_area, final.power_coefficient
+    )
+    return inputs, expected
+
+def assert_matches(result, expected, dtype, rtol):
+    assert result.dtype == dtype
+    np.testing.assert_allclose(result, expected, rtol=rtol, atol=rtol * np.abs(expected).max())
+
+@pytest.mark.parametrize('dtype, rtol', tolerances)
+@pytest.mark.parametrize('backend', available_backends())
+def test_backend_matches_numpy_formulas(kernel_inputs, backend, dtype, rtol):
+    inputs, expected = kernel_inputs
+    result = fused_power_generation(*inputs.values(), **kernel_constants, dtype=dtype, backend=backend)
+    assert_matches(result, expected, dtype, rtol)
+
+@pytest.mark.parametrize('dtype, rtol', tolerances)
+@pytest.mark.parametrize('backend', available_backends())
+def test_backend_matches_numpy_formulas_on_dask_chunks(kernel_inputs, backend, dtype, rtol):
+    # Dask runs the chunks on worker threads, where the numba backend uses its serial build
+    pytest.importorskip('dask')
+    inputs, expected = kernel_inputs
+    arrays = [xr.DataArray(values, dims=('lat', 'lon')).chunk({'lat': 64, 'lon': 96}) for values in inputs.values()]
+    result = xr.apply_ufunc(
+        fused_power_generation, *arrays, kwargs=dict(kernel_constants, dtype=dtype, backend=backend),
+        dask='parallelized', output_dtypes=[dtype]
+    ).compute(scheduler='threads')
+    assert_matches(result.values, expected, dtype, rtol)
+
+def test_unavailable_backend_raises(kernel_inputs):
+    inputs, _ = kernel_inputs
+    with pytest.raises(ValueError):
+        fused_power_generation(*inputs.values(), **kernel_constants, backend='unknown')
+
+@pytest.mark.parametrize('dtype, rtol', tolerances)
+@pytest.mark.parametrize('backend', available_backends())
+def test_backend_with_float32_and_broadcast_inputs(kernel_inputs, backend, dtype, rtol):
+    # float32 climate inputs with a float64 friction layer given for one row, broadcast over the grid
+    inputs, _ = kernel_inputs
+    climate = {name: inputs[name].astype(np.float32) for name in ('sfcWind', 'ps', 'tas', 'hurs')}
+    friction_coefficient = inputs['friction_coefficient'][0]
+    expected = final.calculate_power_generation(
+        final.calculate_wind_at_80m(climate['sfcWind'].astype(np.float64), friction_coefficient, final.reference_height,
+                                    final.target_height),
+        final.calculate_air_density(*(climate[name].astype(np.float64) for name in ('ps', 'tas', 'hurs')), final.Rd, final.Rv,
+                                    final.Kelvin),
+        final.turbine_area, final.power_coefficient
+    )
+    result = fused_power_generation(climate['sfcWind'], friction_coefficient, climate['ps'], climate['tas'], climate['hurs'],
+                                    **kernel_constants, dtype=dtype, backend=backend)
+    assert_matches(result, expected, dtype, rtol)
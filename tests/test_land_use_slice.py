@@ -0,0 +1,31 @@
+import numpy as np
+import xarray as xr
+from land_use_slice import slice_regions
+
+def make_land_use(file_path):
+    lat = np.linspace(59.95, 45.05, 150)
+    lon = np.linspace(-14.95, 4.95, 200)
+    rng = np.random.default_rng(0)
+    ds = xr.Dataset(
+        {
+            'lccs_class': (('time', 'lat', 'lon'), rng.integers(0, 220, (1, lat.size, lon.size), dtype=np.uint8)),
+            'lat_bounds': (('lat', 'bounds'), np.stack([lat + 0.05, lat - 0.05], axis=1)),
+            'lon_bounds': (('lon', 'bounds'), np.stack([lon - 0.05, lon + 0.05], axis=1)),
+            'crs': ((), np.int32(0))
+        },
+        coords={'time': [0], 'lat': lat, 'lon': lon}
+    )
+    ds.to_netcdf(file_path)
+    return ds
+
+def test_slice_regions_with_bounds_variables(tmp_path):
+    source = make_land_use(tmp_path / 'land_use.nc')
+    regions = {str(tmp_path / 'uk.nc'): (-10, 49, 2, 58), str(tmp_path / 'ireland.nc'): (-11, 51, -5, 56)}
+
+    slice_regions(str(tmp_path / 'land_use.nc'), regions, chunk_rows=16)
+
+    for path, (min_lon, min_lat, max_lon, max_lat) in regions.items():
+        expected = source.sel(lat=slice(max_lat, min_lat), lon=slice(min_lon, max_lon))
+        with xr.open_dataset(path) as sliced:
+            for name in ('lccs_class', 'lat_bounds', 'lon_bounds'):
+                np.testing.assert_array_equal(sliced[name].values, expected[name].values)
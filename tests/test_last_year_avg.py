@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import last_year_avg
+from last_year_avg import extract_years
+
+def make_monthly(file_path, first_year=2000, last_year=2100):
+    time = pd.date_range(f"{first_year}-01-01", f"{last_year}-12-01", freq='MS')
+    rng = np.random.default_rng(1)
+    values = rng.gamma(2.0, 3.0, (time.size, 3, 4)).astype(np.float32)
+    values[5, 0, 0] = np.nan
+    ds = xr.Dataset({'sfcWind': (('time', 'lat', 'lon'), values)},
+                    coords={'time': time, 'lat': [50.0, 51.0, 52.0], 'lon': [0.0, 1.0, 2.0, 3.0]})
+    ds.to_netcdf(file_path)
+    return ds
+
+@pytest.fixture
+def read_counter(monkeypatch):
+    # Count the time steps extract_years reads from the source variable
+    counter = {'steps': 0}
+    isel = xr.DataArray.isel
+
+    def counting_isel(self, indexers=None, **kwargs):
+        selection = dict(indexers or {}, **kwargs)
+        if isinstance(selection.get('time'), slice):
+            counter['steps'] += len(range(*selection['time'].indices(self.sizes['time'])))
+        return isel(self, indexers, **kwargs)
+
+    monkeypatch.setattr(xr.DataArray, 'isel', counting_isel)
+    return counter
+
+@pytest.mark.parametrize('window', [1, 3])
+def test_extract_years_reads_only_the_windows(tmp_path, read_counter, window):
+    source = make_monthly(tmp_path / 'sfcWind.nc')
+    years = ['2020', '2050', '2075', '2099']
+
+    extract_years(str(tmp_path / 'sfcWind.nc'), str(tmp_path / 'out'), 'sfcWind', years, time_chunk=7, window=window)
+
+    assert read_counter['steps'] == 12 * window * len(years)
+    for year in years:
+        first_year, last_year = last_year_avg.climatology_window(year, window)
+        expected = source['sfcWind'].sel(time=slice(str(first_year), str(last_year))).mean('time')
+        with xr.open_dataset(tmp_path / 'out' / f"sfcWind_{year}_yearly_avg.nc") as result:
+            np.testing.assert_allclose(result['sfcWind'].values, expected.values, rtol=1e-6)